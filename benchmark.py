@@ -0,0 +1,217 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from create_sample_matrices import SyntheticMatrix
+from sparse_matrix import SparseMatrix
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+OPERATIONS = ("load", "save", "add", "subtract", "multiply", "transpose", "from_coo", "set_element")
+SHAPES = ("square", "tall", "wide")
+DEFAULT_SIZES = (100, 1000, 3000)
+QUICK_SIZES = (100, 300)
+DEFAULT_DENSITIES = (0.001, 0.01)
+DEFAULT_SEED = 2024
+
+
+def operand_shapes(operation, shape, size):
+    narrow = max(1, size // 10)
+    if operation == "multiply":
+        if shape == "square":
+            return (size, size), (size, size)
+        if shape == "tall":
+            return (size, narrow), (narrow, size)
+        return (narrow, size), (size, narrow)
+    if shape == "square":
+        return ((size, size),)
+    if shape == "tall":
+        return ((size, narrow),)
+    return ((narrow, size),)
+
+
+def build_cases(sizes, densities, operations=OPERATIONS, shapes=SHAPES, seed=DEFAULT_SEED):
+    cases = []
+    for operation in operations:
+        for shape in shapes:
+            for size in sizes:
+                for density in densities:
+                    cases.append({
+                        "operation": operation,
+                        "shape": shape,
+                        "size": size,
+                        "density": density,
+                        "seed": seed,
+                    })
+    return cases
+
+
+def case_key(case):
+    return f"{case['operation']}/{case['shape']}/{case['size']}/{case['density']}"
+
+
+def generate_operand(rows, cols, density, rng):
+    return SparseMatrix.from_iterable(SyntheticMatrix(rows, cols, density, rng=rng).entries(), (rows, cols))
+
+
+def _set_element_loop(entries, shape):
+    matrix = SparseMatrix(shape)
+    for row, col, value in entries:
+        matrix.set_element(row, col, value)
+    return matrix.set_storage("csr")
+
+
+def prepare_case(case, directory):
+    rng = random.Random(case["seed"])
+    shapes = operand_shapes(case["operation"], case["shape"], case["size"])
+    if case["operation"] in ("add", "subtract"):
+        shapes = shapes * 2
+    operands = [generate_operand(rows, cols, case["density"], rng) for rows, cols in shapes]
+    input_path = os.path.join(directory, "input.txt")
+    output_path = os.path.join(directory, "output.txt")
+    operation = case["operation"]
+    if operation == "load":
+        operands[0].save_to_file(input_path)
+        return lambda: SparseMatrix(input_path), operands
+    if operation == "save":
+        return lambda: operands[0].save_to_file(output_path), operands
+    if operation == "add":
+        return lambda: operands[0].add(operands[1]), operands
+    if operation == "subtract":
+        return lambda: operands[0].subtract(operands[1]), operands
+    if operation == "transpose":
+        return lambda: operands[0].transpose().set_storage("csr"), operands
+    if operation in ("from_coo", "set_element"):
+        # Both build the same CSR matrix from the same shuffled triplets.
+        entries = [(row, col, value) for (row, col), value in operands[0].items()]
+        rng.shuffle(entries)
+        shape = (operands[0].num_rows, operands[0].num_cols)
+        if operation == "from_coo":
+            return lambda: SparseMatrix.from_iterable(entries, shape), operands
+        return lambda: _set_element_loop(entries, shape), operands
+    return lambda: operands[0].multiply(operands[1]), operands
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak
+
+
+def run_case(case, repeat=3):
+    with tempfile.TemporaryDirectory() as directory:
+        run, operands = prepare_case(case, directory)
+        seconds = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            run()
+            seconds.append(time.perf_counter() - start_time)
+        tracemalloc.start()
+        run()
+        _, peak_allocated = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {
+        **case,
+        "key": case_key(case),
+        "nnz": [operand.nnz for operand in operands],
+        "shapes": [[operand.num_rows, operand.num_cols] for operand in operands],
+        "seconds_min": min(seconds),
+        "seconds_median": statistics.median(seconds),
+        "peak_rss_kb": peak_rss_kb(),
+        "peak_allocated_bytes": peak_allocated,
+    }
+
+
+def run_isolated(case, repeat):
+    with multiprocessing.Pool(processes=1, maxtasksperchild=1) as pool:
+        return pool.apply(run_case, (case, repeat))
+
+
+def run_benchmarks(cases, repeat=3, isolate=True, progress=None):
+    results = []
+    for case in cases:
+        result = run_isolated(case, repeat) if isolate else run_case(case, repeat)
+        results.append(result)
+        if progress:
+            progress(result)
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def compare_to_baseline(report, baseline, threshold=0.25):
+    baseline_results = {result["key"]: result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        previous = baseline_results.get(result["key"])
+        if previous is None or previous["seconds_median"] <= 0:
+            continue
+        ratio = result["seconds_median"] / previous["seconds_median"]
+        if ratio > 1 + threshold:
+            regressions.append({
+                "key": result["key"],
+                "baseline_seconds": previous["seconds_median"],
+                "seconds": result["seconds_median"],
+                "ratio": ratio,
+            })
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark SparseMatrix operations.")
+    parser.add_argument("-o", "--output", default="benchmark_results.json", help="JSON report path")
+    parser.add_argument("--baseline", help="earlier JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed slowdown before a case counts as a regression (0.25 = 25%%)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--sizes", type=int, nargs="+")
+    parser.add_argument("--densities", type=float, nargs="+", default=list(DEFAULT_DENSITIES))
+    parser.add_argument("--operations", nargs="+", choices=OPERATIONS, default=list(OPERATIONS))
+    parser.add_argument("--shapes", nargs="+", choices=SHAPES, default=list(SHAPES))
+    parser.add_argument("--quick", action="store_true", help="only run small sizes")
+    parser.add_argument("--no-isolate", action="store_true",
+                        help="run every case in this process (peak RSS is then cumulative)")
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes or (QUICK_SIZES if args.quick else DEFAULT_SIZES)
+    cases = build_cases(sizes, args.densities, args.operations, args.shapes, args.seed)
+
+    def progress(result):
+        print(f"{result['key']:<32} {result['seconds_median']:.4f}s "
+              f"peak alloc {result['peak_allocated_bytes'] / 1024:.0f} KiB")
+
+    report = run_benchmarks(cases, args.repeat, not args.no_isolate, progress)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare_to_baseline(report, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression['key']}: {regression['baseline_seconds']:.4f}s -> "
+                  f"{regression['seconds']:.4f}s ({regression['ratio']:.2f}x)")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,43 +1,258 @@
+import argparse
+import operator
 import os
 import random
 import shutil
+import sys
+from array import array
+from collections import Counter
+from itertools import accumulate, chain, compress, islice, repeat
+from sparse_matrix import write_binary_stream
+
+STRUCTURES = ("uniform", "banded", "block-diagonal", "power-law", "diagonal-dominant")
+BLOCK_ENTRIES = 1 << 16
+COUNT_BATCH = 1 << 20
 
 def create_sample_directory():
     directory = os.path.join('dsa', 'sparse_matrix', 'sample_inputs')
     os.makedirs(directory, exist_ok=True)
     return directory
 
-def generate_sparse_matrix(rows, cols, density=0.01, value_range=(-1000, 1000)):
-    num_elements = int(rows * cols * density)
-    elements = {}
-    
-    positions = set()
-    while len(positions) < num_elements:
-        row = random.randint(0, rows - 1)
-        col = random.randint(0, cols - 1)
-        positions.add((row, col))
-    
-    for row, col in positions:
-        value = random.randint(value_range[0], value_range[1])
-        while value == 0:
-            value = random.randint(value_range[0], value_range[1])
-        elements[(row, col)] = value
-    
-    return elements
+def _row_spans(structure, rows, cols, bandwidth, block_size):
+    if structure == "banded":
+        starts = [max(0, row - bandwidth) for row in range(rows)]
+        ends = [min(cols, row + bandwidth + 1) for row in range(rows)]
+    elif structure == "block-diagonal":
+        starts = [min(cols, row // block_size * block_size) for row in range(rows)]
+        ends = [min(cols, start + block_size) for start in starts]
+    else:
+        return [0] * rows, [cols] * rows
+    return starts, [max(0, end - start) for start, end in zip(starts, ends)]
+
+def _row_weights(structure, rows, widths, exponent, rng):
+    if structure != "power-law":
+        return widths
+    ranks = list(range(1, rows + 1))
+    rng.shuffle(ranks)
+    return [rank ** -exponent for rank in ranks]
+
+def _random_words(rng, count):
+    # One getrandbits call per batch, cut into 64-bit words by array instead of a Python loop.
+    words = array('Q', rng.getrandbits(64 * count).to_bytes(8 * count, 'little'))
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words
+
+def _row_counts(rng, weights, capacities, total):
+    # Multinomial draw over rows by rejection against the largest weight; rows that fill up hand
+    # their surplus back to the open rows.
+    counts = [0] * len(capacities)
+    while total > 0:
+        open_rows = [row for row, capacity in enumerate(capacities)
+                     if counts[row] < capacity and weights[row] > 0]
+        if not open_rows:
+            break
+        open_weights = [weights[row] for row in open_rows]
+        top = max(open_weights)
+        batch = min(total, COUNT_BATCH)
+        picks = map(operator.mod, _random_words(rng, batch), repeat(len(open_rows)))
+        if min(open_weights) < top:
+            picks = list(picks)
+            thresholds = [int(weight / top * 2 ** 64) for weight in open_weights]
+            accepted = map(operator.lt, _random_words(rng, batch), map(thresholds.__getitem__, picks))
+            picks = compress(picks, accepted)
+        for index, count in Counter(picks).items():
+            row = open_rows[index]
+            count = min(count, capacities[row] - counts[row])
+            counts[row] += count
+            total -= count
+    return counts
+
+def _degree_counts(rng, weights, capacities, total):
+    # Randomized rounding of the expected degrees keeps the power-law shape and the exact total.
+    counts = [0] * len(capacities)
+    while total > 0:
+        open_rows = [row for row, capacity in enumerate(capacities) if counts[row] < capacity]
+        if not open_rows:
+            break
+        scale = total / sum(weights[row] for row in open_rows)
+        offset = rng.random()
+        previous = assigned = 0
+        for row, expected in zip(open_rows, accumulate(weights[row] * scale for row in open_rows)):
+            current = min(total, int(expected + offset))
+            count = min(current - previous, capacities[row] - counts[row])
+            counts[row] += count
+            assigned += count
+            previous = current
+        total -= assigned
+    return counts
+
+def _nonzero_values(rng, count, low, high):
+    words = _random_words(rng, count)
+    if low <= 0 <= high:
+        values = list(map(operator.add, map(operator.mod, words, repeat(high - low)), repeat(low)))
+        return list(map(operator.add, values, map(operator.ge, values, repeat(0))))
+    return list(map(operator.add, map(operator.mod, words, repeat(high - low + 1)), repeat(low)))
+
+class SyntheticMatrix:
+    def __init__(self, rows, cols, density=0.01, structure="uniform", value_range=(-1000, 1000),
+                 rng=random, bandwidth=2, block_size=None, exponent=1.0):
+        if structure not in STRUCTURES:
+            raise ValueError(f"Unknown matrix structure: {structure}")
+        if not 0 <= density <= 1:
+            raise ValueError("Density must be between 0 and 1")
+        low, high = value_range
+        if low > high or low == high == 0:
+            raise ValueError("Value range must contain a non-zero value")
+        self.rows, self.cols = rows, cols
+        self.structure = structure
+        self.value_range = value_range
+        self.rng = rng
+        block_size = block_size or max(1, min(rows, cols) // 10)
+        self.starts, widths = _row_spans(structure, rows, cols, bandwidth, block_size)
+        weights = _row_weights(structure, rows, widths, exponent, rng)
+        if structure == "diagonal-dominant":
+            # The diagonal is always stored; density covers diagonal and off-diagonal entries together.
+            self.diagonal = min(rows, cols)
+            widths = [cols - 1 if row < cols else cols for row in range(rows)]
+            total = int(rows * cols * density) - self.diagonal
+        else:
+            self.diagonal = 0
+            total = int(sum(widths) * density if structure in ("banded", "block-diagonal")
+                        else rows * cols * density)
+        self.widths = widths
+        distribute = _degree_counts if structure == "power-law" else _row_counts
+        self.counts = distribute(rng, weights, widths, min(total, sum(widths)))
+
+    @property
+    def nnz(self):
+        return sum(self.counts) + self.diagonal
+
+    def indptr(self):
+        indptr = array('q', [0])
+        total = 0
+        for row, count in enumerate(self.counts):
+            total += count + (row < self.diagonal)
+            indptr.append(total)
+        return indptr
+
+    def _block_keys(self, start, end):
+        # Packed row * cols + col keys for rows [start, end), drawn for the whole block at once;
+        # duplicate draws show up as equal neighbours after sorting and are drawn again.
+        rng, cols = self.rng, self.cols
+        keys = []
+        pending = {}
+        for row in range(start, end):
+            diagonal = row < self.diagonal
+            count, width, first = self.counts[row], self.widths[row], self.starts[row]
+            if diagonal:
+                keys.append(row * cols + row)
+            if count * 2 > width:
+                others = rng.sample(range(first, first + width), count)
+                if diagonal:
+                    others = [col + (col >= row) for col in others]
+                keys.extend(map(operator.add, others, repeat(row * cols)))
+            elif count:
+                pending[row] = count
+        keys.extend(self._draw_keys(pending))
+        keys.sort()
+        repeated = list(map(operator.eq, keys, islice(keys, 1, None)))
+        if any(repeated):
+            duplicates = compress(islice(keys, 1, None), repeated)
+            pending = Counter(map(operator.floordiv, duplicates, repeat(cols)))
+            keys = list(compress(keys, chain((True,), map(operator.not_, repeated))))
+            present = set(keys)
+            while pending:
+                drawn = set(self._draw_keys(pending)) - present
+                present |= drawn
+                keys.extend(drawn)
+                found = Counter(map(operator.floordiv, drawn, repeat(cols)))
+                pending = {row: count - found[row] for row, count in pending.items() if found[row] < count}
+            keys.sort()
+        return keys
+
+    def _draw_keys(self, pending):
+        cols = self.cols
+        needed = list(pending.values())
+        spans = [self.widths[row] + (row < self.diagonal) for row in pending]
+        bases = [row * cols + self.starts[row] for row in pending]
+        offsets = map(operator.mod, _random_words(self.rng, sum(needed)),
+                      chain.from_iterable(map(repeat, spans, needed)))
+        return map(operator.add, offsets, chain.from_iterable(map(repeat, bases, needed)))
+
+    def blocks(self):
+        low, high = self.value_range
+        block_start = entries = 0
+        for row in range(self.rows):
+            entries += self.counts[row] + (row < self.diagonal)
+            if entries >= BLOCK_ENTRIES or row == self.rows - 1:
+                keys = self._block_keys(block_start, row + 1)
+                indices = array('q', map(operator.mod, keys, repeat(self.cols)))
+                values = _nonzero_values(self.rng, len(keys), low, high)
+                if self.diagonal:
+                    self._dominate(block_start, row + 1, indices, values, max(abs(low), abs(high)))
+                yield block_start, row + 1, indices, array('q', values)
+                block_start = row + 1
+                entries = 0
+
+    def _dominate(self, start, end, indices, values, scale):
+        rng = self.rng
+        position = 0
+        for row in range(start, end):
+            count = self.counts[row] + (row < self.diagonal)
+            if row < self.diagonal:
+                k = position + indices[position:position + count].index(row)
+                off_diagonal = sum(map(abs, values[position:position + count])) - abs(values[k])
+                values[k] = off_diagonal + rng.randint(1, scale)
+            position += count
+
+    def entries(self):
+        for start, end, indices, values in self.blocks():
+            position = 0
+            for row in range(start, end):
+                count = self.counts[row] + (row < self.diagonal)
+                for k in range(position, position + count):
+                    yield row, indices[k], values[k]
+                position += count
+
+    def to_dict(self):
+        return {(row, col): value for row, col, value in self.entries()}
+
+    def write_text(self, file_path):
+        with open(file_path, 'w') as file:
+            file.write(f"rows={self.rows}\ncols={self.cols}\n")
+            for start, end, indices, values in self.blocks():
+                lines = []
+                position = 0
+                for row in range(start, end):
+                    count = self.counts[row] + (row < self.diagonal)
+                    if count:
+                        prefix = f"({row}, "
+                        lines += [f"{prefix}{col}, {value})\n" for col, value in
+                                  zip(indices[position:position + count], values[position:position + count])]
+                        position += count
+                file.write(''.join(lines))
+
+    def write_binary(self, file_path):
+        write_binary_stream(file_path, self.rows, self.cols, self.indptr(),
+                            ((indices, values) for _, _, indices, values in self.blocks()))
+
+    def write(self, file_path, binary=False):
+        if binary:
+            self.write_binary(file_path)
+        else:
+            self.write_text(file_path)
+
+def generate_sparse_matrix(rows, cols, density=0.01, value_range=(-1000, 1000), rng=random, structure="uniform"):
+    return SyntheticMatrix(rows, cols, density, structure, value_range, rng).to_dict()
 
 def write_matrix_to_file(file_path, rows, cols, elements):
     with open(file_path, 'w') as file:
         file.write(f"rows={rows}\n")
         file.write(f"cols={cols}\n")
-        
-        sorted_elements = sorted(elements.items(), key=lambda x: (x[0][0], x[0][1]))
-        
-        for (row, col), value in sorted_elements:
-            file.write(f"({row}, {col}, {value})\n")
+        file.write(''.join(f"({row}, {col}, {value})\n" for (row, col), value in sorted(elements.items())))
 
-def main():
-    directory = create_sample_directory()
-    
+def create_sample_set(directory, rng=random):
     matrix_sizes = [
         (10, 10),
         (100, 100),
@@ -47,14 +262,11 @@ def main():
     ]
     
     for i, (rows, cols) in enumerate(matrix_sizes):
-        elements1 = generate_sparse_matrix(rows, cols)
-        elements2 = generate_sparse_matrix(rows, cols)
-        
         file_path1 = os.path.join(directory, f"matrix_add_sub_{i}_a.txt")
         file_path2 = os.path.join(directory, f"matrix_add_sub_{i}_b.txt")
         
-        write_matrix_to_file(file_path1, rows, cols, elements1)
-        write_matrix_to_file(file_path2, rows, cols, elements2)
+        SyntheticMatrix(rows, cols, rng=rng).write_text(file_path1)
+        SyntheticMatrix(rows, cols, rng=rng).write_text(file_path2)
         
         print(f"Created addition/subtraction matrices: {file_path1}, {file_path2}")
     
@@ -66,14 +278,11 @@ def main():
     ]
     
     for i, ((rows1, cols1), (rows2, cols2)) in enumerate(matrix_pairs):
-        elements1 = generate_sparse_matrix(rows1, cols1)
-        elements2 = generate_sparse_matrix(rows2, cols2)
-        
         file_path1 = os.path.join(directory, f"matrix_mult_{i}_a.txt")
         file_path2 = os.path.join(directory, f"matrix_mult_{i}_b.txt")
         
-        write_matrix_to_file(file_path1, rows1, cols1, elements1)
-        write_matrix_to_file(file_path2, rows2, cols2, elements2)
+        SyntheticMatrix(rows1, cols1, rng=rng).write_text(file_path1)
+        SyntheticMatrix(rows2, cols2, rng=rng).write_text(file_path2)
         
         print(f"Created multiplication matrices: {file_path1}, {file_path2}")
     
@@ -86,15 +295,34 @@ def main():
 
     print(f"Created matrix with incorrect format: {error_file}")
 
-if __name__ == "__main__":
-    main()
-
-
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create sample or synthetic sparse matrix files.")
+    parser.add_argument("-o", "--output", help="write one synthetic matrix here instead of the sample set")
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--cols", type=int, default=1000)
+    parser.add_argument("--density", type=float, default=0.01,
+                        help="fraction of non-zero cells (of the band or blocks for banded and block-diagonal)")
+    parser.add_argument("--structure", choices=STRUCTURES, default="uniform")
+    parser.add_argument("--seed", type=int, help="random seed (same seed, same matrix)")
+    parser.add_argument("--values", type=int, nargs=2, default=(-1000, 1000), metavar=("LOW", "HIGH"))
+    parser.add_argument("--bandwidth", type=int, default=2, help="half bandwidth for banded matrices")
+    parser.add_argument("--block-size", type=int, help="block size for block-diagonal matrices")
+    parser.add_argument("--exponent", type=float, default=1.0, help="row-degree exponent for power-law matrices")
+    parser.add_argument("--binary", action="store_true", help="write the binary format")
+    args = parser.parse_args(argv)
+    rng = random.Random(args.seed)
+    if args.output is None:
+        create_sample_set(create_sample_directory(), rng)
+        return 0
+    try:
+        matrix = SyntheticMatrix(args.rows, args.cols, args.density, args.structure, tuple(args.values), rng,
+                                 args.bandwidth, args.block_size, args.exponent)
+    except ValueError as e:
+        parser.error(str(e))
+    matrix.write(args.output, args.binary)
+    print(f"Created {args.structure} {args.rows}x{args.cols} matrix with {matrix.nnz} non-zero elements: "
+          f"{args.output}")
+    return 0
 
-     
-      
-       
-  
-      
-   
-    
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,12 @@
+import argparse
+import contextlib
+import json
 import os
 import sys
-import time
-from sparse_matrix import SparseMatrix
+from matrix_cache import MatrixCache
+from matrix_expression import Expression, Operand, Product, Sum
+from sparse_matrix import (COMPRESSION_FORMATS, JsonLinesSink, MemorySink, SparseMatrix, convert_matrix_file,
+                           instrument, is_binary_matrix_file)
 
 def clear_screen():
     os.system('cls' if os.name == 'nt' else 'clear')
@@ -19,15 +24,16 @@ def get_operation():
     print("2. Subtraction")
     print("3. Multiplication")
     print("4. View Matrix Details")
-    print("5. Exit")
+    print("5. Convert Matrix File (text <-> binary)")
+    print("6. Exit")
 
     while True:
         try:
-            choice = int(input("\nEnter your choice (1-5): "))
-            if 1 <= choice <= 5:
+            choice = int(input("\nEnter your choice (1-6): "))
+            if 1 <= choice <= 6:
                 return choice
             else:
-                print("Invalid choice. Please enter a number between 1 and 5.")
+                print("Invalid choice. Please enter a number between 1 and 6.")
         except ValueError:
             print("Invalid input. Please enter a number.")
 
@@ -60,17 +66,28 @@ def get_output_file_path():
 def view_matrix_details():
     try:
         file_path = get_file_path("Enter matrix file path: ")
-        start_time = time.time()
-        matrix = SparseMatrix(file_path)
-        load_time = time.time() - start_time
+        with instrument(MemorySink()) as metrics:
+            matrix = SparseMatrix(file_path)
+        load_time = metrics.total_seconds("parse")
 
         print("\nMatrix Details:")
         print(f"Dimensions: {matrix.num_rows} x {matrix.num_cols}")
-        print(f"Non-zero elements: {len(matrix.elements)}")
-        print(f"Sparsity: {1 - len(matrix.elements) / (matrix.num_rows * matrix.num_cols):.4f} " +
-              f"({len(matrix.elements)} / {matrix.num_rows * matrix.num_cols})")
+        print(f"Structure: {matrix.structure}")
+        print(f"Non-zero elements: {matrix.nnz}")
+        print(f"Sparsity: {1 - matrix.nnz / (matrix.num_rows * matrix.num_cols):.4f} " +
+              f"({matrix.nnz} / {matrix.num_rows * matrix.num_cols})")
         print(f"Load time: {load_time:.4f} seconds")
 
+        if matrix.num_rows and matrix.num_cols:
+            row_counts = matrix.nnz_per_row()
+            print(f"Min / max value: {matrix.min()} / {matrix.max()}")
+            print(f"Sum of elements: {sum(matrix.row_sums())}")
+            print(f"Frobenius norm: {matrix.norm():.6g}")
+            if matrix.num_rows == matrix.num_cols:
+                print(f"Trace: {matrix.trace()}")
+            print(f"Non-zeros per row: max {max(row_counts)}, "
+                  f"mean {matrix.nnz / matrix.num_rows:.2f}, empty rows {row_counts.count(0)}")
+
         if matrix.num_rows <= 10 and matrix.num_cols <= 10:
             print("\nMatrix content:")
             for i in range(matrix.num_rows):
@@ -81,7 +98,7 @@ def view_matrix_details():
         else:
             print("\nSample of non-zero elements:")
             count = 0
-            for (row, col), value in sorted(matrix.elements.items()):
+            for (row, col), value in matrix.items():
                 print(f"({row}, {col}) = {value}")
                 count += 1
                 if count >= 10:
@@ -93,54 +110,225 @@ def view_matrix_details():
 
     input("\nPress Enter to continue...")
 
+def convert_matrix():
+    try:
+        source = get_file_path("Enter matrix file path: ")
+        target_format = "text" if is_binary_matrix_file(source) else "binary"
+        print(f"Converting to {target_format} format.")
+        output_file = get_output_file_path()
+        with instrument(MemorySink()) as metrics:
+            matrix = convert_matrix_file(source, output_file)
+        print(f"\nConverted {matrix.nnz} non-zero elements in {metrics.total_seconds():.4f} seconds")
+        print(f"Result saved to '{output_file}'")
+
+    except Exception as e:
+        print(f"\nError: {e}")
+
+    input("\nPress Enter to continue...")
+
 def perform_operation(operation):
     try:
         file1 = get_file_path("Enter first matrix file path: ")
         file2 = get_file_path("Enter second matrix file path: ")
 
         print("\nLoading matrices...")
-        start_time = time.time()
-        matrix1 = SparseMatrix(file1)
-        matrix2 = SparseMatrix(file2)
-        load_time = time.time() - start_time
-        print(f"Matrices loaded in {load_time:.4f} seconds")
+        with instrument(MemorySink()) as metrics:
+            matrix1 = SparseMatrix(file1)
+            matrix2 = SparseMatrix(file2)
+        print(f"Matrices loaded in {metrics.total_seconds('parse'):.4f} seconds")
 
         print(f"\nPerforming {'addition' if operation == 1 else 'subtraction' if operation == 2 else 'multiplication'}...")
-        start_time = time.time()
-
-        if operation == 1:
-            result = matrix1.add(matrix2)
-        elif operation == 2:
-            result = matrix1.subtract(matrix2)
-        else:
-            result = matrix1.multiply(matrix2)
-
-        operation_time = time.time() - start_time
-        print(f"Operation completed in {operation_time:.4f} seconds")
+        with instrument(MemorySink()) as metrics:
+            if operation == 1:
+                result = matrix1.add(matrix2)
+            elif operation == 2:
+                result = matrix1.subtract(matrix2)
+            else:
+                result = matrix1.multiply(matrix2)
+        record = metrics.records[-1]
+        print(f"Operation completed in {record['seconds']:.4f} seconds")
+        if "flops" in record:
+            print(f"Multiply-add operations: {record['flops']}")
 
         output_file = get_output_file_path()
         result.save_to_file(output_file)
         print(f"\nResult saved to '{output_file}'")
         print(f"Result dimensions: {result.num_rows} x {result.num_cols}")
-        print(f"Non-zero elements in result: {len(result.elements)}")
+        print(f"Non-zero elements in result: {result.nnz}")
 
     except Exception as e:
         print(f"\nError: {e}")
 
     input("\nPress Enter to continue...")
 
+def parse_operand_options(parser, options):
+    operands = {}
+    position = 0
+    while position < len(options):
+        option = options[position]
+        if not option.startswith("--") or len(option) == 2:
+            parser.error(f"unrecognized argument: {option}")
+        name, separator, path = option[2:].partition("=")
+        if not separator:
+            if position + 1 >= len(options):
+                parser.error(f"operand {name} needs a file path")
+            position += 1
+            path = options[position]
+        operands[name] = path
+        position += 1
+    return operands
+
+def save_like(matrix, source_path, output_path):
+    if is_binary_matrix_file(source_path):
+        matrix.save_binary(output_path)
+    else:
+        matrix.save_to_file(output_path)
+
+def run_update(args, operand_paths, parser):
+    try:
+        root = Expression(args.expression).root
+    except ValueError as e:
+        parser.error(str(e))
+    if isinstance(root, Product) and len(root.factors) == 2:
+        operands = root.factors
+    elif isinstance(root, Sum) and len(root.terms) == 2:
+        operands = [node for _, node in root.terms]
+    else:
+        operands = []
+    if len(operands) != 2 or not all(isinstance(node, Operand) for node in operands):
+        parser.error("update supports a single A+B, A-B or A*B expression")
+    names = [node.name for node in operands]
+
+    delta_paths = {}
+    for option in args.delta:
+        name, separator, path = option.partition("=")
+        if not separator or name not in names:
+            parser.error(f"--delta expects NAME=PATH for an operand of the expression, got {option!r}")
+        delta_paths[name] = path
+    if not delta_paths:
+        parser.error("at least one --delta is required")
+    required = set(names) if isinstance(root, Product) else set()
+    if args.update_operands:
+        required |= set(delta_paths)
+    missing = sorted(required - set(operand_paths))
+    if missing:
+        parser.error(f"no file given for operand(s): {', '.join(missing)}")
+
+    try:
+        deltas = {name: SparseMatrix(path) for name, path in delta_paths.items()}
+        operand_matrices = {name: SparseMatrix(operand_paths[name]) for name in required}
+        result = SparseMatrix(args.result)
+        if isinstance(root, Product):
+            left, right = names
+            result.apply_product_delta(operand_matrices[left], operand_matrices[right],
+                                       deltas.get(left), deltas.get(right))
+        else:
+            for (sign, _), name in zip(root.terms, names):
+                if name in deltas:
+                    result.apply_delta(deltas[name], subtract=sign < 0)
+        save_like(result, args.result, args.output or args.result)
+        if args.update_operands:
+            for name, delta in deltas.items():
+                save_like(operand_matrices[name].apply_delta(delta), operand_paths[name], operand_paths[name])
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+def run_batch(argv):
+    parser = argparse.ArgumentParser(
+        prog="main.py",
+        description="Evaluate a sparse matrix expression without prompting. "
+                    "Operands are given as --NAME PATH.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    eval_parser = subparsers.add_parser("eval", help="evaluate an expression such as \"A*B + C - D\"")
+    eval_parser.add_argument("expression")
+    eval_parser.add_argument("-o", "--output", required=True, help="result file path")
+    eval_parser.add_argument("--binary", action="store_true", help="save the result in binary format")
+    eval_parser.add_argument("--compress", choices=sorted(COMPRESSION_FORMATS),
+                             help="compress the text result (default: from the .gz/.bz2/.xz suffix)")
+    eval_parser.add_argument("--workers", type=int, help="worker processes for parsing and multiplication")
+    eval_parser.add_argument("--timing", action="store_true", help="print timings as JSON on stdout")
+    eval_parser.add_argument("--metrics", help="append per-operation metrics as JSON lines to this file")
+    eval_parser.add_argument("--cache-dir", help="keep parsed operands in this directory between runs")
+    update_parser = subparsers.add_parser(
+        "update", help="update a saved result of \"A+B\", \"A-B\" or \"A*B\" from delta files")
+    update_parser.add_argument("expression")
+    update_parser.add_argument("--result", required=True, help="saved result of the expression")
+    update_parser.add_argument("--delta", action="append", default=[], metavar="NAME=PATH",
+                               help="file of (row, col, change) entries for operand NAME (repeatable)")
+    update_parser.add_argument("-o", "--output", help="updated result path (default: overwrite --result)")
+    update_parser.add_argument("--update-operands", action="store_true",
+                               help="also apply the deltas to the operand files")
+    args, extra = parser.parse_known_args(argv)
+    if args.command == "update":
+        return run_update(args, parse_operand_options(update_parser, extra), update_parser)
+    operand_paths = parse_operand_options(eval_parser, extra)
+
+    try:
+        expression = Expression(args.expression)
+    except ValueError as e:
+        eval_parser.error(str(e))
+    missing = sorted(expression.names - set(operand_paths))
+    if missing:
+        eval_parser.error(f"no file given for operand(s): {', '.join(missing)}")
+
+    metrics = MemorySink()
+    try:
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(instrument(metrics))
+            if args.metrics:
+                metrics_file = JsonLinesSink(args.metrics)
+                stack.callback(metrics_file.close)
+                stack.enter_context(instrument(metrics_file))
+            cache = MatrixCache(cache_dir=args.cache_dir) if args.cache_dir else None
+            operands = {name: cache.load(operand_paths[name], "auto") if cache
+                        else SparseMatrix.load(operand_paths[name], "auto", args.workers)
+                        for name in expression.names}
+            plan = expression.plan(operands)
+            result = expression.evaluate(operands, workers=args.workers)
+            if args.binary:
+                result.save_binary(args.output)
+            else:
+                result.save_to_file(args.output, args.compress)
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    if args.timing:
+        timings = {
+            "load_seconds": metrics.total_seconds("parse"),
+            "evaluate_seconds": metrics.total_seconds("add", "subtract", "multiply", "sum"),
+            "save_seconds": metrics.total_seconds("save"),
+        }
+        print(json.dumps({
+            "expression": args.expression,
+            "plan": plan,
+            "rows": result.num_rows,
+            "cols": result.num_cols,
+            "nnz": result.nnz,
+            **timings,
+            "total_seconds": sum(timings.values()),
+            "operations": metrics.records,
+        }))
+    return 0
+
 def main():
+    if len(sys.argv) > 1:
+        sys.exit(run_batch(sys.argv[1:]))
     while True:
         clear_screen()
         print_banner()
 
         choice = get_operation()
 
-        if choice == 5:
+        if choice == 6:
             print("\nExiting program. Goodbye!")
             sys.exit(0)
         elif choice == 4:
             view_matrix_details()
+        elif choice == 5:
+            convert_matrix()
         else:
             perform_operation(choice)
 
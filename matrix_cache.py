@@ -0,0 +1,122 @@
+import hashlib
+import os
+from collections import OrderedDict
+from sparse_matrix import SparseMatrix
+
+HASH_BLOCK_SIZE = 1 << 20
+DEFAULT_MAX_BYTES = 256 << 20
+
+
+def file_digest(file_path):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class _CacheEntry:
+    def __init__(self, identity, digest, compressed):
+        self.identity = identity
+        self.digest = digest
+        self.compressed = compressed
+        self.nbytes = compressed.nbytes
+
+
+class MatrixCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+        }
+
+    def load(self, file_path, storage=None):
+        layout = "csc" if storage == "csc" else "csr"
+        key = (os.path.realpath(file_path), layout)
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"File not found: {file_path}")
+        identity = (stat.st_size, stat.st_mtime_ns)
+        digest = None
+        entry = self._entries.get(key)
+        if entry is not None and entry.identity != identity:
+            digest = file_digest(file_path)
+            if digest == entry.digest:
+                entry.identity = identity
+            else:
+                self._discard(key)
+                self.invalidations += 1
+                entry = None
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        else:
+            self.misses += 1
+            if digest is None:
+                digest = file_digest(file_path)
+            entry = _CacheEntry(identity, digest, self._load_uncached(file_path, digest, layout))
+            self._insert(key, entry)
+        matrix = SparseMatrix._from_compressed(entry.compressed)
+        if storage:
+            matrix.set_storage(storage)
+        return matrix
+
+    def clear(self):
+        self._entries.clear()
+        self.current_bytes = 0
+
+    def _sidecar_path(self, digest, layout):
+        return os.path.join(self.cache_dir, f"{digest}.{layout}.spmx")
+
+    def _load_uncached(self, file_path, digest, layout):
+        if self.cache_dir:
+            sidecar = self._sidecar_path(digest, layout)
+            if os.path.exists(sidecar):
+                self.disk_hits += 1
+                return SparseMatrix(sidecar, layout)._as_compressed(layout)
+        matrix = SparseMatrix(file_path, layout)
+        if self.cache_dir:
+            self._write_sidecar(matrix, self._sidecar_path(digest, layout))
+        return matrix._as_compressed(layout)
+
+    def _write_sidecar(self, matrix, sidecar):
+        temporary = f"{sidecar}.{os.getpid()}.tmp"
+        try:
+            matrix.save_binary(temporary)
+            os.replace(temporary, sidecar)
+        except (ValueError, OSError):
+            for leftover in (temporary, temporary + ".partial"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+    def _insert(self, key, entry):
+        self._entries[key] = entry
+        self.current_bytes += entry.nbytes
+        while self.current_bytes > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self._discard(oldest)
+            self.evictions += 1
+
+    def _discard(self, key):
+        entry = self._entries.pop(key)
+        self.current_bytes -= entry.nbytes
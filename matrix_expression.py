@@ -0,0 +1,233 @@
+import re
+from sparse_matrix import SparseMatrix, linear_combination
+
+_TOKEN = re.compile(r'\s*(?:([A-Za-z_]\w*)|(\S))')
+
+
+class Operand:
+    def __init__(self, name):
+        self.name = name
+        self.key = ("operand", name)
+
+
+class Sum:
+    def __init__(self, terms):
+        self.terms = terms
+        self.key = ("sum", tuple((sign, node.key) for sign, node in terms))
+
+
+class Product:
+    def __init__(self, factors):
+        self.factors = factors
+        self.key = ("product", tuple(node.key for node in factors))
+
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        name, symbol = match.groups()
+        if symbol is not None and symbol not in "+-*()":
+            raise ValueError(f"Unexpected character in expression: {symbol!r}")
+        tokens.append(name or symbol)
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    def __init__(self, text):
+        self.tokens = _tokenize(text)
+        self.position = 0
+        self.nodes = {}
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise ValueError("Unexpected end of expression")
+        self.position += 1
+        return token
+
+    def _intern(self, node):
+        return self.nodes.setdefault(node.key, node)
+
+    def parse(self):
+        if not self.tokens:
+            raise ValueError("Expression is empty")
+        node = self._expression()
+        if self._peek() is not None:
+            raise ValueError(f"Unexpected token in expression: {self._peek()!r}")
+        return node
+
+    def _expression(self):
+        terms = []
+        sign = 1
+        if self._peek() == "-":
+            self._next()
+            sign = -1
+        self._add_term(terms, sign, self._term())
+        while self._peek() in ("+", "-"):
+            sign = 1 if self._next() == "+" else -1
+            self._add_term(terms, sign, self._term())
+        if len(terms) == 1 and terms[0][0] == 1:
+            return terms[0][1]
+        return self._intern(Sum(terms))
+
+    def _add_term(self, terms, sign, node):
+        if isinstance(node, Sum):
+            terms.extend((sign * inner_sign, inner) for inner_sign, inner in node.terms)
+        else:
+            terms.append((sign, node))
+
+    def _term(self):
+        factors = []
+        self._add_factor(factors, self._factor())
+        while self._peek() == "*":
+            self._next()
+            self._add_factor(factors, self._factor())
+        if len(factors) == 1:
+            return factors[0]
+        return self._intern(Product(factors))
+
+    def _add_factor(self, factors, node):
+        if isinstance(node, Product):
+            factors.extend(node.factors)
+        else:
+            factors.append(node)
+
+    def _factor(self):
+        token = self._next()
+        if token == "(":
+            node = self._expression()
+            if self._next() != ")":
+                raise ValueError("Missing closing parenthesis in expression")
+            return node
+        if token in "+-*)":
+            raise ValueError(f"Unexpected token in expression: {token!r}")
+        return self._intern(Operand(token))
+
+
+def _multiply_estimate(left, right):
+    left_rows, inner, left_nnz = left
+    _, right_cols, right_nnz = right
+    flops = left_nnz * right_nnz / inner if inner else 0
+    return flops, (left_rows, right_cols, min(left_rows * right_cols, flops))
+
+
+class Expression:
+    def __init__(self, text):
+        self.text = text
+        self.root = _Parser(text).parse()
+
+    @property
+    def names(self):
+        names = set()
+        pending = [self.root]
+        while pending:
+            node = pending.pop()
+            if isinstance(node, Operand):
+                names.add(node.name)
+            elif isinstance(node, Sum):
+                pending.extend(inner for _, inner in node.terms)
+            else:
+                pending.extend(node.factors)
+        return names
+
+    def _estimate(self, node, operands):
+        if isinstance(node, Operand):
+            matrix = operands[node.name]
+            return matrix.num_rows, matrix.num_cols, matrix.nnz
+        if isinstance(node, Sum):
+            estimates = [self._estimate(inner, operands) for _, inner in node.terms]
+            num_rows, num_cols, _ = estimates[0]
+            return num_rows, num_cols, min(num_rows * num_cols, sum(nnz for _, _, nnz in estimates))
+        return self._chain_order(node, operands)[1][(0, len(node.factors) - 1)]
+
+    def _chain_order(self, node, operands):
+        factors = [self._estimate(inner, operands) for inner in node.factors]
+        for left, right in zip(factors, factors[1:]):
+            if left[1] != right[0]:
+                raise ValueError("Matrix dimensions do not match for multiplication")
+        count = len(factors)
+        cost = {(i, i): 0 for i in range(count)}
+        estimate = {(i, i): factors[i] for i in range(count)}
+        split = {}
+        for length in range(2, count + 1):
+            for i in range(count - length + 1):
+                j = i + length - 1
+                for k in range(i, j):
+                    flops, result = _multiply_estimate(estimate[(i, k)], estimate[(k + 1, j)])
+                    total = cost[(i, k)] + cost[(k + 1, j)] + flops
+                    if (i, j) not in cost or total < cost[(i, j)]:
+                        cost[(i, j)] = total
+                        estimate[(i, j)] = result
+                        split[(i, j)] = k
+        return split, estimate
+
+    def _describe(self, node, operands):
+        if isinstance(node, Operand):
+            return node.name
+        if isinstance(node, Sum):
+            text = ""
+            for sign, inner in node.terms:
+                if text:
+                    text += " + " if sign > 0 else " - "
+                elif sign < 0:
+                    text += "-"
+                text += self._describe(inner, operands)
+            return f"sum({text})"
+        split, _ = self._chain_order(node, operands)
+
+        def describe_range(i, j):
+            if i == j:
+                return self._describe(node.factors[i], operands)
+            k = split[(i, j)]
+            return f"({describe_range(i, k)} * {describe_range(k + 1, j)})"
+
+        return describe_range(0, len(node.factors) - 1)
+
+    def plan(self, operands):
+        self._check_operands(operands)
+        return self._describe(self.root, operands)
+
+    def _check_operands(self, operands):
+        missing = sorted(self.names - set(operands))
+        if missing:
+            raise ValueError(f"No matrix given for operand(s): {', '.join(missing)}")
+
+    def evaluate(self, operands, workers=None):
+        self._check_operands(operands)
+        return self._evaluate(self.root, operands, {}, workers)
+
+    def _evaluate(self, node, operands, results, workers):
+        if node.key in results:
+            return results[node.key]
+        if isinstance(node, Operand):
+            result = operands[node.name]
+        elif isinstance(node, Sum):
+            result = linear_combination(
+                (sign, self._evaluate(inner, operands, results, workers)) for sign, inner in node.terms)
+        else:
+            split, _ = self._chain_order(node, operands)
+
+            def evaluate_range(i, j):
+                if i == j:
+                    return self._evaluate(node.factors[i], operands, results, workers)
+                k = split[(i, j)]
+                return evaluate_range(i, k).multiply(evaluate_range(k + 1, j), workers=workers)
+
+            result = evaluate_range(0, len(node.factors) - 1)
+        results[node.key] = result
+        return result
+
+
+def evaluate_expression(text, operands, workers=None):
+    operands = {name: matrix if isinstance(matrix, SparseMatrix) else SparseMatrix(matrix)
+                for name, matrix in operands.items()}
+    return Expression(text).evaluate(operands, workers)
@@ -0,0 +1,230 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from matrix_cache import MatrixCache
+
+MAX_MESSAGE_BYTES = 64 << 20
+BINARY_OPERATIONS = {"add": "+", "subtract": "-", "multiply": "*"}
+
+
+def _field(request, name):
+    try:
+        return request[name]
+    except KeyError:
+        raise ValueError(f"Missing request field: {name}") from None
+
+
+def _shared(matrix):
+    # Requests run concurrently on the executor threads, so the storage that operations would
+    # otherwise switch to or index lazily is built once, before other requests can see the matrix.
+    matrix.freeze()._as_compressed("csr")
+    return matrix
+
+
+def _describe(name, matrix):
+    return {"name": name, "rows": matrix.num_rows, "cols": matrix.num_cols, "nnz": matrix.nnz}
+
+
+class MatrixService:
+    def __init__(self, threads=None, workers=None, cache=None):
+        self.matrices = {}
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.workers = workers
+        self.cache = cache or MatrixCache()
+        self.cache_lock = threading.Lock()
+        self.clients = {}
+        self.stopped = None
+
+    def _matrix(self, name):
+        matrix = self.matrices.get(name)
+        if matrix is None:
+            raise ValueError(f"No matrix named {name!r}")
+        return matrix
+
+    def _load(self, path, storage):
+        with self.cache_lock:
+            matrix = self.cache.load(path, storage)
+        return _shared(matrix)
+
+    def _combine(self, op, left, right):
+        return _shared(getattr(left, op)(right, self.workers))
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def handle(self, request):
+        op = request.get("op")
+        if op == "ping":
+            return {}
+        if op == "list":
+            return {"matrices": [_describe(name, matrix) for name, matrix in sorted(self.matrices.items())]}
+        if op == "load":
+            name = _field(request, "name")
+            matrix = await self._run(self._load, _field(request, "path"), request.get("storage"))
+            self.matrices[name] = matrix
+            return _describe(name, matrix)
+        if op in BINARY_OPERATIONS:
+            left_name, right_name = _field(request, "left"), _field(request, "right")
+            left, right = self._matrix(left_name), self._matrix(right_name)
+            name = request.get("name") or f"{left_name}{BINARY_OPERATIONS[op]}{right_name}"
+            matrix = await self._run(self._combine, op, left, right)
+            self.matrices[name] = matrix
+            return _describe(name, matrix)
+        if op == "matvec":
+            matrix = self._matrix(_field(request, "name"))
+            return {"vector": await self._run(matrix.matvec, _field(request, "vector"))}
+        if op == "save":
+            matrix = self._matrix(_field(request, "name"))
+            path = _field(request, "path")
+            if request.get("binary"):
+                await self._run(matrix.save_binary, path)
+            else:
+                await self._run(matrix.save_to_file, path, request.get("compression"))
+            return {"path": path}
+        if op == "drop":
+            name = _field(request, "name")
+            self._matrix(name)
+            del self.matrices[name]
+            return {}
+        if op == "shutdown":
+            self.stopped.set()
+            return {}
+        raise ValueError(f"Unknown operation: {op!r}")
+
+    async def _respond(self, line):
+        start = time.perf_counter()
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("Request must be a JSON object")
+            response = {"ok": True, **await self.handle(request)}
+        except (ValueError, IndexError, TypeError, OSError) as e:
+            response = {"ok": False, "error": str(e)}
+        except KeyError as e:
+            response = {"ok": False, "error": f"KeyError: {e}"}
+        response["seconds"] = time.perf_counter() - start
+        return response
+
+    async def _serve_client(self, reader, writer):
+        self.clients[writer] = asyncio.current_task()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    writer.write(b'{"ok": false, "error": "Request too large"}\n')
+                    break
+                if not line:
+                    break
+                writer.write(json.dumps(await self._respond(line)).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            writer.close()
+
+    async def serve(self, socket_path, ready=None):
+        self.stopped = asyncio.Event()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(self._serve_client, socket_path, limit=MAX_MESSAGE_BYTES)
+        try:
+            if ready is not None:
+                ready.set()
+            await self.stopped.wait()
+        finally:
+            server.close()
+            clients = list(self.clients.items())
+            for writer, _ in clients:
+                writer.close()
+            await asyncio.gather(*(task for _, task in clients), return_exceptions=True)
+            await server.wait_closed()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+
+def run_server(socket_path, threads=None, workers=None, ready=None):
+    asyncio.run(MatrixService(threads, workers).serve(socket_path, ready))
+
+
+class MatrixClient:
+    def __init__(self, socket_path, timeout=None):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        self.socket.connect(socket_path)
+        self.file = self.socket.makefile('rwb')
+
+    def request(self, op, **fields):
+        self.file.write(json.dumps({"op": op, **fields}).encode() + b"\n")
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("Matrix service closed the connection")
+        response = json.loads(line)
+        if not response.pop("ok"):
+            raise ValueError(response["error"])
+        return response
+
+    def ping(self):
+        return self.request("ping")
+
+    def list(self):
+        return self.request("list")["matrices"]
+
+    def load(self, name, path, storage=None):
+        return self.request("load", name=name, path=os.path.abspath(path), storage=storage)
+
+    def add(self, left, right, name=None):
+        return self.request("add", left=left, right=right, name=name)
+
+    def subtract(self, left, right, name=None):
+        return self.request("subtract", left=left, right=right, name=name)
+
+    def multiply(self, left, right, name=None):
+        return self.request("multiply", left=left, right=right, name=name)
+
+    def matvec(self, name, vector):
+        return self.request("matvec", name=name, vector=list(vector))["vector"]
+
+    def save(self, name, path, binary=False, compression=None):
+        return self.request("save", name=name, path=os.path.abspath(path), binary=binary,
+                            compression=compression)
+
+    def drop(self, name):
+        return self.request("drop", name=name)
+
+    def shutdown(self):
+        return self.request("shutdown")
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve resident SparseMatrix operands on a Unix socket.")
+    parser.add_argument("socket", help="Unix domain socket path")
+    parser.add_argument("--threads", type=int, help="threads running matrix operations")
+    parser.add_argument("--workers", type=int, help="worker processes for add, subtract and multiply")
+    args = parser.parse_args(argv)
+    print(f"Serving matrices on {args.socket}")
+    run_server(args.socket, args.threads, args.workers)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,324 @@
+import heapq
+import operator
+import os
+import tempfile
+from array import array
+from itertools import islice
+from sparse_matrix import _multiply_compressed, _read_text_file, stream_entries
+
+DEFAULT_RUN_ENTRIES = 1_000_000
+DEFAULT_MEMORY_ENTRIES = 4_000_000
+WRITE_BATCH_ENTRIES = 10_000
+FILE_OPERATIONS = {
+    "add": ("addition", operator.add, None),
+    "subtract": ("subtraction", operator.sub, operator.neg),
+}
+
+
+class _UnsortedInput(Exception):
+    def __init__(self, source):
+        super().__init__(source)
+        self.source = source
+
+
+def _entry_key(entry):
+    return entry[0], entry[1]
+
+
+class EntryWriter:
+    def __init__(self, file_path, num_rows, num_cols, batch_entries=WRITE_BATCH_ENTRIES):
+        self.file = open(file_path, 'w')
+        self.file.write(f"rows={num_rows}\ncols={num_cols}\n")
+        self.batch_entries = batch_entries
+        self.pending = []
+        self.count = 0
+
+    def write(self, row, col, value):
+        self.pending.append(f"({row}, {col}, {value})\n")
+        if len(self.pending) >= self.batch_entries:
+            self.flush()
+
+    def write_all(self, entries):
+        for row, col, value in entries:
+            self.write(row, col, value)
+
+    def flush(self):
+        self.count += len(self.pending)
+        self.file.write(''.join(self.pending))
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _ordered(entries, source):
+    # Adjacent duplicates follow the loader's last-value-wins rule.
+    previous = None
+    for entry in entries:
+        if previous is not None:
+            if entry[:2] < previous[:2]:
+                raise _UnsortedInput(source)
+            if entry[:2] != previous[:2]:
+                yield previous
+        previous = entry
+    if previous is not None:
+        yield previous
+
+
+def _write_runs(entries, num_rows, num_cols, directory, run_entries):
+    paths = []
+    while True:
+        run = list(islice(entries, run_entries))
+        if not run:
+            return paths
+        run.sort(key=_entry_key)
+        path = os.path.join(directory, f"run{len(paths)}.txt")
+        with EntryWriter(path, num_rows, num_cols) as writer:
+            writer.write_all(run)
+        paths.append(path)
+
+
+def external_sort(file_path, directory, run_entries=DEFAULT_RUN_ENTRIES):
+    num_rows, num_cols, entries = stream_entries(file_path)
+    run_directory = tempfile.mkdtemp(dir=directory)
+    paths = _write_runs(entries, num_rows, num_cols, run_directory, run_entries)
+    runs = [stream_entries(path)[2] for path in paths]
+    # heapq.merge keeps equal keys in run order, so the last duplicate still wins.
+    return _ordered(heapq.merge(*runs, key=_entry_key), file_path)
+
+
+def _sorted_stream(file_path, directory, presorted, run_entries):
+    if presorted:
+        return _ordered(stream_entries(file_path)[2], file_path)
+    return external_sort(file_path, directory, run_entries)
+
+
+def merge_streams(a, b, both, b_only=None):
+    a_entry = next(a, None)
+    b_entry = next(b, None)
+    while a_entry is not None and b_entry is not None:
+        a_key, b_key = a_entry[:2], b_entry[:2]
+        if a_key < b_key:
+            yield a_entry
+            a_entry = next(a, None)
+        elif b_key < a_key:
+            value = b_only(b_entry[2]) if b_only else b_entry[2]
+            yield b_entry[0], b_entry[1], value
+            b_entry = next(b, None)
+        else:
+            value = both(a_entry[2], b_entry[2])
+            if value:
+                yield a_entry[0], a_entry[1], value
+            a_entry = next(a, None)
+            b_entry = next(b, None)
+    if a_entry is not None:
+        yield a_entry
+        yield from a
+    while b_entry is not None:
+        yield b_entry[0], b_entry[1], b_only(b_entry[2]) if b_only else b_entry[2]
+        b_entry = next(b, None)
+
+
+def add_files(a_path, b_path, out_path, op="add", run_entries=DEFAULT_RUN_ENTRIES):
+    if op not in FILE_OPERATIONS:
+        raise ValueError(f"Unknown file operation: {op}")
+    operation, both, b_only = FILE_OPERATIONS[op]
+    num_rows, num_cols, _ = stream_entries(a_path)
+    if stream_entries(b_path)[:2] != (num_rows, num_cols):
+        raise ValueError(f"Matrix dimensions do not match for {operation}")
+    partial_path = out_path + ".partial"
+    unsorted = set()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            while True:
+                a = _sorted_stream(a_path, directory, a_path not in unsorted, run_entries)
+                b = _sorted_stream(b_path, directory, b_path not in unsorted, run_entries)
+                try:
+                    with EntryWriter(partial_path, num_rows, num_cols) as writer:
+                        writer.write_all(merge_streams(a, b, both, b_only))
+                    break
+                except _UnsortedInput as error:
+                    unsorted.add(error.source)
+                finally:
+                    a.close()
+                    b.close()
+        os.replace(partial_path, out_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    return writer.count
+
+
+def _row_counts(file_path):
+    num_rows, num_cols, entries = stream_entries(file_path)
+    counts = array('q', bytes(8 * num_rows))
+    for row, _, _ in entries:
+        counts[row] += 1
+    return num_rows, num_cols, counts
+
+
+def _block_boundaries(counts, budget):
+    boundaries = [0]
+    current = 0
+    for index, count in enumerate(counts):
+        if current and current + count > budget:
+            boundaries.append(index)
+            current = 0
+        current += count
+    boundaries.append(len(counts))
+    return boundaries
+
+
+def _block_lookup(boundaries):
+    lookup = array('q')
+    for block, (start, end) in enumerate(zip(boundaries, boundaries[1:])):
+        lookup.extend([block] * (end - start))
+    return lookup
+
+
+class _TileWriter:
+    def __init__(self, directory, name, row_bounds, col_bounds):
+        self.directory = directory
+        self.name = name
+        self.row_bounds = row_bounds
+        self.col_bounds = col_bounds
+        self.pending = {}
+        self.pending_count = 0
+        self.written = set()
+
+    def path(self, tile):
+        return os.path.join(self.directory, f"{self.name}_{tile[0]}_{tile[1]}.txt")
+
+    def add(self, tile, row, col, value):
+        lines = self.pending.get(tile)
+        if lines is None:
+            lines = self.pending[tile] = []
+        lines.append(f"({row - self.row_bounds[tile[0]]}, {col - self.col_bounds[tile[1]]}, {value})\n")
+        self.pending_count += 1
+        if self.pending_count >= WRITE_BATCH_ENTRIES:
+            self.flush()
+
+    def flush(self):
+        for tile, lines in self.pending.items():
+            with open(self.path(tile), 'a' if tile in self.written else 'w') as file:
+                if tile not in self.written:
+                    row_block, col_block = tile
+                    file.write(f"rows={self.row_bounds[row_block + 1] - self.row_bounds[row_block]}\n"
+                               f"cols={self.col_bounds[col_block + 1] - self.col_bounds[col_block]}\n")
+                    self.written.add(tile)
+                file.write(''.join(lines))
+        self.pending = {}
+        self.pending_count = 0
+
+
+def _partition(file_path, writer, row_lookup, col_lookup):
+    for row, col, value in stream_entries(file_path)[2]:
+        writer.add((row_lookup[row], col_lookup[col]), row, col, value)
+    writer.flush()
+
+
+def _product_chunks(a, b, budget):
+    # A row of the product has at most min(flops, columns) entries; consecutive rows are grouped
+    # so that no partial product can hold more than budget entries.
+    a_indptr, a_indices, b_indptr = a.indptr, a.indices, b.indptr
+    start = current = 0
+    for row in range(a.num_rows):
+        inners = a_indices[a_indptr[row]:a_indptr[row + 1]]
+        bound = min(b.num_cols, sum(b_indptr[inner + 1] - b_indptr[inner] for inner in inners))
+        if current and current + bound > budget:
+            yield start, row
+            start, current = row, 0
+        current += bound
+    if start < a.num_rows:
+        yield start, a.num_rows
+
+
+def _write_product(writer, product, row_offset, col_offset):
+    indptr, indices, data = product.indptr, product.indices, product.data
+    for row in range(product.num_rows):
+        for position in range(indptr[row], indptr[row + 1]):
+            writer.write(row + row_offset, indices[position] + col_offset, data[position])
+
+
+def _sum_sorted(entries):
+    current = None
+    for entry in entries:
+        if current is not None and current[:2] == entry[:2]:
+            current = current[0], current[1], current[2] + entry[2]
+            continue
+        if current is not None and current[2]:
+            yield current
+        current = entry
+    if current is not None and current[2]:
+        yield current
+
+
+def _report(progress, stage, done, total):
+    if progress:
+        progress(stage, done, total)
+
+
+def multiply_files(a_path, b_path, out_path, memory_entries=DEFAULT_MEMORY_ENTRIES, progress=None):
+    a_rows, inner, a_counts = _row_counts(a_path)
+    b_rows, b_cols, b_counts = _row_counts(b_path)
+    if inner != b_rows:
+        raise ValueError("Matrix dimensions do not match for multiplication")
+    # The budget is shared by one tile of A, one tile of B and one partial product. B is also split
+    # by column so that a single product row can never outgrow its share.
+    share = max(1, memory_entries // 3)
+    row_bounds = _block_boundaries(a_counts, share)
+    inner_bounds = _block_boundaries(b_counts, share)
+    col_bounds = list(range(0, b_cols, share)) + [b_cols]
+    del a_counts, b_counts
+    row_blocks, inner_blocks, col_blocks = len(row_bounds) - 1, len(inner_bounds) - 1, len(col_bounds) - 1
+    partial_path = out_path + ".partial"
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            a_tiles = _TileWriter(directory, "a", row_bounds, inner_bounds)
+            b_tiles = _TileWriter(directory, "b", inner_bounds, col_bounds)
+            _partition(a_path, a_tiles, _block_lookup(row_bounds), _block_lookup(inner_bounds))
+            _report(progress, "partition", 1, 2)
+            _partition(b_path, b_tiles, _block_lookup(inner_bounds), _block_lookup(col_bounds))
+            _report(progress, "partition", 2, 2)
+
+            products = {}
+            for inner_block in range(inner_blocks):
+                for col_block in range(col_blocks):
+                    if (inner_block, col_block) not in b_tiles.written:
+                        continue
+                    b_tile = _read_text_file(b_tiles.path((inner_block, col_block)))
+                    for row_block in range(row_blocks):
+                        tile = (row_block, inner_block)
+                        if tile not in a_tiles.written:
+                            continue
+                        a_tile = _read_text_file(a_tiles.path(tile))
+                        path = os.path.join(directory, f"c_{row_block}_{inner_block}_{col_block}.txt")
+                        with EntryWriter(path, a_tile.num_rows, b_cols) as writer:
+                            for start, end in _product_chunks(a_tile, b_tile, share):
+                                product = _multiply_compressed(a_tile, b_tile, start, end)
+                                _write_product(writer, product, start, col_bounds[col_block])
+                                del product
+                        products.setdefault(row_block, []).append(path)
+                        del a_tile
+                    del b_tile
+                _report(progress, "multiply", inner_block + 1, inner_blocks)
+
+            with EntryWriter(partial_path, a_rows, b_cols) as writer:
+                for row_block in range(row_blocks):
+                    partials = [stream_entries(path)[2] for path in products.get(row_block, ())]
+                    offset = row_bounds[row_block]
+                    for row, col, value in _sum_sorted(heapq.merge(*partials, key=_entry_key)):
+                        writer.write(row + offset, col, value)
+                    _report(progress, "merge", row_block + 1, row_blocks)
+        os.replace(partial_path, out_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    return writer.count
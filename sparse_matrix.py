@@ -1,114 +1,2434 @@
+import bisect
+import bz2
+import gzip
+import io
+import json
+import logging
+import lzma
+import math
+import mmap
+import operator
+import os
+import pickle
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import chain, compress, islice, repeat
+
+INDEX_TYPECODE = 'q'
+STRUCTURED_FORMATS = ("diagonal", "banded", "symmetric")
+STORAGE_FORMATS = ("dict", "packed", "csr", "csc") + STRUCTURED_FORMATS
+DUPLICATE_POLICIES = ("sum", "last", "error")
+READ_CHUNK_SIZE = 1 << 20
+WRITE_BATCH_ENTRIES = 1 << 16
+BINARY_MAGIC = b"SPMX"
+BINARY_VERSION = 1
+PARALLEL_BLOCKS_PER_WORKER = 4
+PARALLEL_PARSE_RANGE_BYTES = 64 << 20
+DENSE_ROW_THRESHOLD = 0.3
+BAND_FILL_THRESHOLD = 0.5
+SYMMETRY_SAMPLES = 32
+_EMPTY_KEY = -1
+_DELETED_KEY = -2
+
+_BINARY_HEADER = struct.Struct('<4sBccxqqq')
+
+
+
+def _index_buffer(values=()):
+    return array(INDEX_TYPECODE, values)
+
+
+def _value_buffer(values=()):
+    values = list(values)
+    try:
+        return array('q', values)
+    except (TypeError, OverflowError):
+        if all(isinstance(value, float) for value in values):
+            return array('d', values)
+        return values
+
+
+def _buffer_nbytes(buffer):
+    if isinstance(buffer, (array, memoryview)):
+        return len(buffer) * buffer.itemsize
+    return sys.getsizeof(buffer) + sum(sys.getsizeof(value) for value in buffer)
+
+
+def _cumulative(counts):
+    indptr = _index_buffer([0])
+    total = 0
+    for count in counts:
+        total += count
+        indptr.append(total)
+    return indptr
+
+
+class CompressedStorage:
+    def __init__(self, layout, num_rows, num_cols, indptr, indices, data):
+        if layout not in ("csr", "csc"):
+            raise ValueError(f"Unknown storage layout: {layout}")
+        self.layout = layout
+        self.num_rows = num_rows
+        self.num_cols = num_cols
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    @property
+    def num_major(self):
+        return self.num_rows if self.layout == "csr" else self.num_cols
+
+    @property
+    def num_minor(self):
+        return self.num_cols if self.layout == "csr" else self.num_rows
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    @property
+    def nbytes(self):
+        return sum(_buffer_nbytes(buffer) for buffer in (self.indptr, self.indices, self.data))
+
+    @classmethod
+    def empty(cls, layout, num_rows, num_cols):
+        num_major = num_rows if layout == "csr" else num_cols
+        return cls(layout, num_rows, num_cols, _index_buffer(bytes(8 * (num_major + 1))),
+                   _index_buffer(), _value_buffer())
+
+    @classmethod
+    def from_dict(cls, elements, num_rows, num_cols, layout="csr"):
+        if layout == "csr":
+            keys = sorted(elements)
+            majors = [row for row, _ in keys]
+            minors = [col for _, col in keys]
+        else:
+            keys = sorted(elements, key=lambda key: (key[1], key[0]))
+            majors = [col for _, col in keys]
+            minors = [row for row, _ in keys]
+        values = [elements[key] for key in keys]
+        return cls.from_sorted(layout, num_rows, num_cols, majors, minors, values)
+
+    @classmethod
+    def from_sorted(cls, layout, num_rows, num_cols, majors, minors, values):
+        num_major = num_rows if layout == "csr" else num_cols
+        majors = majors if isinstance(majors, list) else list(majors)
+        indptr = _index_buffer(map(bisect.bisect_left, repeat(majors), range(num_major + 1)))
+        return cls(layout, num_rows, num_cols, indptr, _index_buffer(minors), _value_buffer(values))
+
+    def to_dict(self):
+        counts = map(operator.sub, islice(self.indptr, 1, None), self.indptr)
+        majors = chain.from_iterable(map(repeat, range(self.num_major), counts))
+        if self.layout == "csr":
+            keys = zip(majors, self.indices)
+        else:
+            keys = zip(self.indices, majors)
+        return dict(zip(keys, self.data))
+
+    def convert(self, layout):
+        if layout == self.layout:
+            return self
+        if layout not in ("csr", "csc"):
+            raise ValueError(f"Unknown storage layout: {layout}")
+        indptr, indices, data = self.indptr, self.indices, self.data
+        counts = [0] * self.num_minor
+        for minor in indices:
+            counts[minor] += 1
+        new_indptr = _cumulative(counts)
+        next_slot = list(new_indptr[:-1])
+        new_indices = _index_buffer(bytes(8 * self.nnz))
+        new_data = [0] * self.nnz
+        for major in range(self.num_major):
+            for k in range(indptr[major], indptr[major + 1]):
+                slot = next_slot[indices[k]]
+                next_slot[indices[k]] = slot + 1
+                new_indices[slot] = major
+                new_data[slot] = data[k]
+        return CompressedStorage(layout, self.num_rows, self.num_cols,
+                                 new_indptr, new_indices, _value_buffer(new_data))
+
+    def get(self, row, col):
+        major, minor = (row, col) if self.layout == "csr" else (col, row)
+        lo, hi = self.indptr[major], self.indptr[major + 1]
+        k = bisect.bisect_left(self.indices, minor, lo, hi)
+        if k < hi and self.indices[k] == minor:
+            return self.data[k]
+        return 0
+
+    def items(self):
+        indptr, indices, data = self.indptr, self.indices, self.data
+        csr = self.layout == "csr"
+        for major in range(self.num_major):
+            for k in range(indptr[major], indptr[major + 1]):
+                if csr:
+                    yield (major, indices[k]), data[k]
+                else:
+                    yield (indices[k], major), data[k]
+
+
+class PackedStorage:
+    # Open-addressing table keyed by row * num_cols + col, probed like CPython's dict.
+    def __init__(self, num_rows, num_cols, capacity=8):
+        if num_rows * num_cols > 1 << 63:
+            raise ValueError("Matrix is too large for packed keys")
+        self.num_rows = num_rows
+        self.num_cols = num_cols
+        self._allocate(capacity, array('q'))
+
+    def _allocate(self, capacity, like):
+        self.keys = _index_buffer([_EMPTY_KEY]) * capacity
+        if isinstance(like, array):
+            self.values = array(like.typecode, bytes(like.itemsize * capacity))
+        else:
+            self.values = [0] * capacity
+        self.float_values = isinstance(like, array) and like.typecode == 'd'
+        self.mask = capacity - 1
+        self.limit = capacity * 2 // 3
+        self.size = 0
+        self.used = 0
+
+    @classmethod
+    def from_items(cls, items, num_rows, num_cols, count=0):
+        table = cls(num_rows, num_cols, _table_capacity(count))
+        for (row, col), value in items:
+            table.set(row, col, value)
+        return table
+
+    @property
+    def nnz(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return _buffer_nbytes(self.keys) + _buffer_nbytes(self.values)
+
+    def _find(self, key):
+        # Returns the slot holding key, or ~slot of the slot to insert it into.
+        keys, mask = self.keys, self.mask
+        slot = key & mask
+        perturb = key
+        free = -1
+        while True:
+            found = keys[slot]
+            if found == key:
+                return slot
+            if found == _EMPTY_KEY:
+                return ~(slot if free < 0 else free)
+            if found == _DELETED_KEY and free < 0:
+                free = slot
+            perturb >>= 5
+            slot = (slot * 5 + perturb + 1) & mask
+
+    def _live_slots(self):
+        return list(compress(range(len(self.keys)), map(operator.ge, self.keys, repeat(0))))
+
+    def _widen(self, slot, value):
+        # Same widening as _value_buffer: 'q', then 'd' for all-float data, then a list.
+        if isinstance(value, float) and not self.float_values and self.size == 1:
+            self.values = array('d', bytes(8 * len(self.keys)))
+            self.float_values = True
+        else:
+            self.values = list(self.values)
+            self.float_values = False
+        self.values[slot] = value
+
+    def _assign(self, slot, key, value):
+        if value == 0:
+            if slot >= 0:
+                self.keys[slot] = _DELETED_KEY
+                self.values[slot] = 0
+                self.size -= 1
+            return
+        if slot < 0:
+            slot = ~slot
+            if self.keys[slot] == _EMPTY_KEY:
+                if self.used >= self.limit:
+                    self._resize(self.size + 1)
+                    slot = ~self._find(key)
+                self.used += 1
+            self.keys[slot] = key
+            self.size += 1
+        if self.float_values and not isinstance(value, float):
+            self._widen(slot, value)
+            return
+        try:
+            self.values[slot] = value
+        except (TypeError, OverflowError):
+            self._widen(slot, value)
+
+    def _resize(self, count):
+        keys, values = self.keys, self.values
+        self._allocate(_table_capacity(count), values)
+        new_keys, new_values, mask = self.keys, self.values, self.mask
+        size = 0
+        for key, value in zip(keys, values):
+            if key < 0:
+                continue
+            size += 1
+            slot = key & mask
+            perturb = key
+            while new_keys[slot] != _EMPTY_KEY:
+                perturb >>= 5
+                slot = (slot * 5 + perturb + 1) & mask
+            new_keys[slot] = key
+            new_values[slot] = value
+        self.size = self.used = size
+
+    def get(self, row, col):
+        slot = self._find(row * self.num_cols + col)
+        if slot < 0:
+            return 0
+        return self.values[slot]
+
+    def set(self, row, col, value):
+        key = row * self.num_cols + col
+        self._assign(self._find(key), key, value)
+
+    def accumulate(self, row, col, value, both, b_only=None):
+        key = row * self.num_cols + col
+        slot = self._find(key)
+        if slot >= 0:
+            value = both(self.values[slot], value)
+        elif b_only is not None:
+            value = b_only(value)
+        self._assign(slot, key, value)
+
+    def stored_values(self):
+        return list(map(self.values.__getitem__, self._live_slots()))
+
+    def items(self):
+        keys, values, num_cols = self.keys, self.values, self.num_cols
+        for slot in self._live_slots():
+            yield divmod(keys[slot], num_cols), values[slot]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def to_compressed(self, layout="csr"):
+        keys = self.keys
+        slots = sorted(self._live_slots(), key=keys.__getitem__)
+        packed = list(map(keys.__getitem__, slots))
+        num_cols = max(self.num_cols, 1)
+        rows = list(map(operator.floordiv, packed, repeat(num_cols)))
+        cols = list(map(operator.mod, packed, repeat(num_cols)))
+        storage = CompressedStorage.from_sorted("csr", self.num_rows, self.num_cols, rows, cols,
+                                                list(map(self.values.__getitem__, slots)))
+        return storage.convert(layout)
+
+    def transpose(self):
+        table = PackedStorage(self.num_cols, self.num_rows, len(self.keys))
+        for (row, col), value in self.items():
+            table.set(col, row, value)
+        return table
+
+
+def _table_capacity(count):
+    capacity = 8
+    while capacity < 2 * count:
+        capacity <<= 1
+    return capacity
+
+
+def _band_buffer(values):
+    # Like _value_buffer, but integer zero padding does not keep float data out of a 'd' array.
+    values = list(values)
+    buffer = _value_buffer(values)
+    if isinstance(buffer, list) and all(isinstance(value, float) for value in filter(None, values)):
+        return array('d', values)
+    return buffer
+
+
+def _band_limits(storage):
+    # Furthest entry below and above the diagonal, read off the first and last column of each row.
+    indptr, indices = storage.indptr, storage.indices
+    lower = upper = 0
+    for row, (lo, hi) in enumerate(zip(indptr, islice(indptr, 1, None))):
+        if lo != hi:
+            lower = max(lower, row - indices[lo])
+            upper = max(upper, indices[hi - 1] - row)
+    return lower, upper
+
+
+def _is_narrow_band(storage, lower, upper):
+    # A band as wide as the matrix is no band at all; full triangles and dense symmetric matrices
+    # are left to the checks after it.
+    width = lower + upper + 1
+    return width < storage.num_rows and width * storage.num_rows * BAND_FILL_THRESHOLD <= storage.nnz
+
+
+def _same_values(a, b):
+    if not isinstance(a, list) and not isinstance(b, list):
+        return a == b
+    return (len(a) == len(b) and all(map(operator.is_, map(type, a), map(type, b)))
+            and all(map(operator.eq, a, b)))
+
+
+def _is_symmetric(storage):
+    if storage.num_rows != storage.num_cols:
+        return False
+    indptr, indices, data = storage.indptr, storage.indices, storage.data
+    # Mirror a few sampled entries first so most general matrices are rejected without a transpose.
+    for k in range(0, storage.nnz, max(1, storage.nnz // SYMMETRY_SAMPLES)):
+        row = bisect.bisect_right(indptr, k) - 1
+        if storage.get(indices[k], row) != data[k]:
+            return False
+    transposed = storage.convert("csc")
+    return (_same_values(transposed.indptr, indptr) and _same_values(transposed.indices, indices)
+            and _same_values(transposed.data, data))
+
+
+def _detect_structure(storage):
+    if storage.num_rows != storage.num_cols:
+        return "general"
+    lower, upper = _band_limits(storage)
+    if lower == upper == 0:
+        return "diagonal"
+    if _is_narrow_band(storage, lower, upper):
+        return "banded"
+    if lower == upper and _is_symmetric(storage):
+        return "symmetric"
+    if lower == 0:
+        return "upper-triangular"
+    if upper == 0:
+        return "lower-triangular"
+    return "general"
+
+
+def _structured_storage(kind, storage):
+    if storage.num_rows != storage.num_cols:
+        raise ValueError(f"Only square matrices can use {kind} storage")
+    lower, upper = _band_limits(storage)
+    if kind == "diagonal":
+        if lower or upper:
+            raise ValueError("Matrix is not diagonal")
+        return DiagonalStorage.from_compressed(storage)
+    if kind == "banded":
+        if not _is_narrow_band(storage, lower, upper):
+            raise ValueError("Matrix is not banded")
+        return BandStorage.from_compressed(storage, lower, upper)
+    if not _is_symmetric(storage):
+        raise ValueError("Matrix is not symmetric")
+    return SymmetricStorage.from_compressed(storage)
+
+
+class DiagonalStorage:
+    kind = "diagonal"
+
+    def __init__(self, size, values):
+        self.num_rows = self.num_cols = size
+        self.values = values
+        self.nnz = sum(map(bool, values))
+
+    @classmethod
+    def from_compressed(cls, storage):
+        values = [0] * storage.num_rows
+        indptr, data = storage.indptr, storage.data
+        for row, (lo, hi) in enumerate(zip(indptr, islice(indptr, 1, None))):
+            if lo != hi:
+                values[row] = data[lo]
+        return cls(storage.num_rows, _band_buffer(values))
+
+    @property
+    def nbytes(self):
+        return _buffer_nbytes(self.values)
+
+    def get(self, row, col):
+        if row != col:
+            return 0
+        return self.values[row] or 0
+
+    def entries(self):
+        positions = range(self.num_rows)
+        return compress(zip(positions, positions, self.values), self.values)
+
+    def items(self):
+        for row, col, value in self.entries():
+            yield (row, col), value
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def to_compressed(self, layout="csr"):
+        # A diagonal matrix has the same arrays in both layouts.
+        return CompressedStorage.from_sorted(layout, self.num_rows, self.num_cols,
+                                             *_unzip_entries(self.entries()))
+
+    def transpose(self):
+        return self
+
+    def matvec(self, x):
+        return [value * item if value else 0 for value, item in zip(self.values, x)]
+
+
+class BandStorage:
+    kind = "banded"
+
+    # bands[lower + offset][i] holds entry (i + max(0, -offset), i + max(0, offset)); positions
+    # inside the band without an entry hold zeros.
+    def __init__(self, size, lower, upper, bands):
+        self.num_rows = self.num_cols = size
+        self.lower = lower
+        self.upper = upper
+        self.bands = bands
+        self.nnz = sum(sum(map(bool, band)) for band in bands)
+
+    @classmethod
+    def from_compressed(cls, storage, lower, upper):
+        size = storage.num_rows
+        bands = [[0] * (size - abs(offset)) for offset in range(-lower, upper + 1)]
+        indptr, indices, data = storage.indptr, storage.indices, storage.data
+        for row in range(size):
+            for k in range(indptr[row], indptr[row + 1]):
+                col = indices[k]
+                bands[lower + col - row][min(row, col)] = data[k]
+        return cls(size, lower, upper, [_band_buffer(band) for band in bands])
+
+    @property
+    def nbytes(self):
+        return sum(_buffer_nbytes(band) for band in self.bands)
+
+    def diagonals(self):
+        return zip(range(-self.lower, self.upper + 1), self.bands)
+
+    def band(self, offset):
+        if -self.lower <= offset <= self.upper:
+            return self.bands[self.lower + offset]
+        return None
+
+    def get(self, row, col):
+        band = self.band(col - row)
+        if band is None:
+            return 0
+        return band[min(row, col)] or 0
+
+    def _aligned(self, per_band):
+        # Pads each band's sequence to one value per row, so zip(*...) walks a row across the band.
+        size = self.num_rows
+        aligned = []
+        for (offset, band), values in zip(self.diagonals(), per_band):
+            start = max(0, -offset)
+            aligned.append([0] * start + list(values) + [0] * (size - start - len(band)))
+        return aligned
+
+    def _cells(self):
+        # Row-major (row, col, value) for every position of the band, padding included.
+        rows = chain.from_iterable(map(repeat, range(self.num_rows), repeat(len(self.bands))))
+        cols = chain.from_iterable(zip(*self._aligned(
+            range(max(0, offset), max(0, offset) + len(band)) for offset, band in self.diagonals())))
+        return zip(rows, cols, chain.from_iterable(zip(*self._aligned(self.bands))))
+
+    def entries(self):
+        return filter(operator.itemgetter(2), self._cells())
+
+    def items(self):
+        for row, col, value in self.entries():
+            yield (row, col), value
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def to_compressed(self, layout="csr"):
+        storage = CompressedStorage.from_sorted("csr", self.num_rows, self.num_cols,
+                                                *_unzip_entries(self.entries()))
+        return storage.convert(layout)
+
+    def transpose(self):
+        return BandStorage(self.num_rows, self.upper, self.lower, self.bands[::-1])
+
+    def matvec(self, x):
+        products = [map(operator.mul, band, x[max(0, offset):max(0, offset) + len(band)])
+                    for offset, band in self.diagonals()]
+        sums = map(sum, zip(*self._aligned(products)))
+        occupied = map(any, zip(*self._aligned(self.bands)))
+        return [total if filled else 0 for total, filled in zip(sums, occupied)]
+
+
+class SymmetricStorage:
+    kind = "symmetric"
+
+    # upper is the CSR storage of the diagonal and everything above it.
+    def __init__(self, upper):
+        self.num_rows = self.num_cols = upper.num_rows
+        self.upper = upper
+        indptr, indices = upper.indptr, upper.indices
+        diagonal = sum(1 for row, (lo, hi) in enumerate(zip(indptr, islice(indptr, 1, None)))
+                       if lo != hi and indices[lo] == row)
+        self.nnz = 2 * upper.nnz - diagonal
+
+    @classmethod
+    def from_compressed(cls, storage):
+        indptr, indices, data = storage.indptr, storage.indices, storage.data
+        counts = []
+        upper_indices = _index_buffer()
+        upper_data = []
+        for row in range(storage.num_rows):
+            lo, hi = indptr[row], indptr[row + 1]
+            start = bisect.bisect_left(indices, row, lo, hi)
+            counts.append(hi - start)
+            upper_indices.extend(indices[start:hi])
+            upper_data.extend(data[start:hi])
+        return cls(CompressedStorage("csr", storage.num_rows, storage.num_cols, _cumulative(counts),
+                                     upper_indices, _value_buffer(upper_data)))
+
+    @property
+    def nbytes(self):
+        return self.upper.nbytes
+
+    def get(self, row, col):
+        return self.upper.get(min(row, col), max(row, col))
+
+    def rows(self):
+        upper = self.upper
+        # The columns of the upper half are the rows of the lower half; each column ends with its
+        # diagonal entry, which the upper row already holds.
+        lower = upper.convert("csc")
+        lower_indices, lower_data = lower.indices, lower.data
+        upper_indices, upper_data = upper.indices, upper.data
+        bounds = zip(lower.indptr, islice(lower.indptr, 1, None), upper.indptr, islice(upper.indptr, 1, None))
+        for row, (lo, hi, upper_lo, upper_hi) in enumerate(bounds):
+            if upper_lo != upper_hi and upper_indices[upper_lo] == row:
+                hi -= 1
+            if lo != hi or upper_lo != upper_hi:
+                yield (row, lower_indices[lo:hi] + upper_indices[upper_lo:upper_hi],
+                       lower_data[lo:hi] + upper_data[upper_lo:upper_hi])
+
+    def entries(self):
+        return chain.from_iterable(zip(repeat(row), cols, values) for row, cols, values in self.rows())
+
+    def items(self):
+        for row, cols, values in self.rows():
+            for col, value in zip(cols, values):
+                yield (row, col), value
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def to_compressed(self, layout="csr"):
+        counts = [0] * self.num_rows
+        indices = _index_buffer()
+        data = []
+        for row, cols, values in self.rows():
+            counts[row] = len(cols)
+            indices.extend(cols)
+            data.extend(values)
+        # A symmetric matrix has the same arrays in both layouts.
+        return CompressedStorage(layout, self.num_rows, self.num_cols, _cumulative(counts), indices,
+                                 _value_buffer(data))
+
+    def transpose(self):
+        return self
+
+    def matvec(self, x):
+        upper = self.upper
+        if _buffer_typecode(upper.data) == 'q' and set(map(type, x)) <= {int}:
+            # Integer sums do not depend on the order of their terms, so the lower half can be
+            # scattered from the upper rows instead of being gathered row by row.
+            result = _gather_vector(upper, x)
+            indptr, indices, data = upper.indptr, upper.indices, upper.data
+            for row in range(self.num_rows):
+                lo, hi = indptr[row], indptr[row + 1]
+                if lo != hi and indices[lo] == row:
+                    lo += 1
+                x_value = x[row]
+                for k in range(lo, hi):
+                    result[indices[k]] += data[k] * x_value
+            return result
+        result = [0] * self.num_rows
+        lookup = x.__getitem__
+        for row, cols, values in self.rows():
+            result[row] = sum(map(operator.mul, values, map(lookup, cols)))
+        return result
+
+
+def _as_band(storage):
+    if storage.kind == "diagonal":
+        return BandStorage(storage.num_rows, 0, 0, [storage.values])
+    return storage
+
+
+def _merge_values(a, b, both, b_only=None):
+    values = []
+    for x, y in zip(a, b):
+        if not y:
+            values.append(x)
+        elif not x:
+            values.append(b_only(y) if b_only else y)
+        else:
+            values.append(both(x, y))
+    return _band_buffer(values)
+
+
+def _merge_structured(a, b, both, b_only=None):
+    if a.kind == "symmetric":
+        return SymmetricStorage(_merge_compressed(a.upper, b.upper, both, b_only=b_only))
+    if a.kind == b.kind == "diagonal":
+        return DiagonalStorage(a.num_rows, _merge_values(a.values, b.values, both, b_only))
+    a, b = _as_band(a), _as_band(b)
+    lower, upper = max(a.lower, b.lower), max(a.upper, b.upper)
+    bands = []
+    for offset in range(-lower, upper + 1):
+        a_band, b_band = a.band(offset), b.band(offset)
+        if b_band is None:
+            bands.append(a_band)
+        elif a_band is None:
+            bands.append(_band_buffer(b_only(y) if y else y for y in b_band) if b_only else b_band)
+        else:
+            bands.append(_merge_values(a_band, b_band, both, b_only))
+    return BandStorage(a.num_rows, lower, upper, bands)
+
+
+def _padding_is_exact(storage, x=None):
+    # Band and dense-row kernels also multiply the zero padding; the extra 0 * v terms leave every
+    # sum, and its type, as the sparse kernels compute it only for int or finite float data.
+    bands = [storage.data] if isinstance(storage, CompressedStorage) else _as_band(storage).bands
+    typecodes = set(map(_buffer_typecode, bands))
+    try:
+        if typecodes == {'d'}:
+            finite = all(all(map(math.isfinite, band)) for band in bands)
+        elif typecodes == {'q'}:
+            finite = True
+        else:
+            return False
+        if x is None:
+            return finite
+        types = set(map(type, x))
+        if not types <= {int, float} or not all(map(math.isfinite, x)):
+            return False
+    except OverflowError:
+        return False
+    return typecodes == {'d'} or len(types) <= 1
+
+
+def _scale_band(factors, band_storage, rows):
+    bands = []
+    for offset, band in band_storage.diagonals():
+        start = max(0, -offset) if rows else max(0, offset)
+        scale = factors[start:start + len(band)]
+        if rows:
+            bands.append(_band_buffer(s * v if s and v else 0 for s, v in zip(scale, band)))
+        else:
+            bands.append(_band_buffer(v * s if s and v else 0 for s, v in zip(scale, band)))
+    return BandStorage(band_storage.num_rows, band_storage.lower, band_storage.upper, bands)
+
+
+def _scale_rows(factors, storage):
+    scales = []
+    for factor, count in zip(factors, _row_counts(storage)):
+        scales += repeat(factor, count)
+    return _with_data(storage, [s * v if s else 0 for s, v in zip(scales, storage.data)])
+
+
+def _scale_cols(storage, factors):
+    scales = map(factors.__getitem__, storage.indices)
+    return _with_data(storage, [v * s if s else 0 for v, s in zip(storage.data, scales)])
+
+
+def _multiply_bands(a, b):
+    size = a.num_rows
+    limit = max(size - 1, 0)
+    lower, upper = min(a.lower + b.lower, limit), min(a.upper + b.upper, limit)
+    bands = [[0] * (size - abs(offset)) for offset in range(-lower, upper + 1)]
+    # Offsets of A ascend in the outer loop, so every entry sums its products in the same
+    # inner-index order as _multiply_compressed.
+    for a_offset, a_band in a.diagonals():
+        for b_offset, b_band in b.diagonals():
+            offset = a_offset + b_offset
+            start = max(0, -a_offset, -offset)
+            stop = min(size, size - a_offset, size - offset)
+            if not -lower <= offset <= upper or start >= stop:
+                continue
+            a_values = a_band[start + min(0, a_offset):stop + min(0, a_offset)]
+            b_values = b_band[start + min(a_offset, offset):stop + min(a_offset, offset)]
+            target = bands[lower + offset]
+            lo, hi = start + min(0, offset), stop + min(0, offset)
+            target[lo:hi] = map(operator.add, target[lo:hi], map(operator.mul, a_values, b_values))
+    return BandStorage(size, lower, upper, [_band_buffer(band) for band in bands])
+
+
+def _structured_kernel(operation, a, b):
+    kinds = (a.kind if a else None, b.kind if b else None)
+    if operation == "multiply":
+        if "diagonal" in kinds:
+            return "diagonal"
+        if kinds == ("banded", "banded") and _padding_is_exact(a) and _padding_is_exact(b):
+            return "banded"
+        return None
+    if kinds == ("symmetric", "symmetric"):
+        return "symmetric"
+    if kinds[0] in ("diagonal", "banded") and kinds[1] in ("diagonal", "banded"):
+        return "diagonal" if kinds == ("diagonal", "diagonal") else "banded"
+    return None
+
+
+def _sum_compressed(terms, num_rows, num_cols):
+    accumulator = [0] * num_cols
+    marker = [-1] * num_cols
+    counts = []
+    indices = _index_buffer()
+    data = []
+    for row in range(num_rows):
+        cols = []
+        for coefficient, storage in terms:
+            storage_indices, storage_data = storage.indices, storage.data
+            for k in range(storage.indptr[row], storage.indptr[row + 1]):
+                col = storage_indices[k]
+                if marker[col] != row:
+                    marker[col] = row
+                    accumulator[col] = coefficient * storage_data[k]
+                    cols.append(col)
+                else:
+                    accumulator[col] += coefficient * storage_data[k]
+        cols.sort()
+        row_start = len(indices)
+        for col in cols:
+            value = accumulator[col]
+            if value != 0:
+                indices.append(col)
+                data.append(value)
+        counts.append(len(indices) - row_start)
+    return CompressedStorage("csr", num_rows, num_cols, _cumulative(counts),
+                             indices, _value_buffer(data))
+
+
+def _append_merged(indices, data, index, value, transform):
+    if transform is not None:
+        value = transform(value)
+        if value == 0:
+            return
+    indices.append(index)
+    data.append(value)
+
+
+def _block_shape(layout, num_rows, num_cols, start, end):
+    if layout == "csr":
+        return end - start, num_cols
+    return num_rows, end - start
+
+
+def _merge_compressed(a, b, both, a_only=None, b_only=None, start=0, end=None):
+    a_indptr, a_indices, a_data = a.indptr, a.indices, a.data
+    b_indptr, b_indices, b_data = b.indptr, b.indices, b.data
+    if end is None:
+        end = a.num_major
+    counts = []
+    indices = _index_buffer()
+    data = []
+    for major in range(start, end):
+        major_start = len(indices)
+        i, i_end = a_indptr[major], a_indptr[major + 1]
+        j, j_end = b_indptr[major], b_indptr[major + 1]
+        while i < i_end and j < j_end:
+            a_minor, b_minor = a_indices[i], b_indices[j]
+            if a_minor < b_minor:
+                _append_merged(indices, data, a_minor, a_data[i], a_only)
+                i += 1
+            elif b_minor < a_minor:
+                _append_merged(indices, data, b_minor, b_data[j], b_only)
+                j += 1
+            else:
+                value = both(a_data[i], b_data[j])
+                if value != 0:
+                    indices.append(a_minor)
+                    data.append(value)
+                i += 1
+                j += 1
+        if a_only is None:
+            indices.extend(a_indices[i:i_end])
+            data.extend(a_data[i:i_end])
+        else:
+            for k in range(i, i_end):
+                _append_merged(indices, data, a_indices[k], a_data[k], a_only)
+        if b_only is None:
+            indices.extend(b_indices[j:j_end])
+            data.extend(b_data[j:j_end])
+        else:
+            for k in range(j, j_end):
+                _append_merged(indices, data, b_indices[k], b_data[k], b_only)
+        counts.append(len(indices) - major_start)
+    num_rows, num_cols = _block_shape(a.layout, a.num_rows, a.num_cols, start, end)
+    return CompressedStorage(a.layout, num_rows, num_cols, _cumulative(counts),
+                             indices, _value_buffer(data))
+
+
+def _slice_majors(storage, start, end):
+    lo, hi = storage.indptr[start], storage.indptr[end]
+    indptr = _index_buffer(pointer - lo for pointer in storage.indptr[start:end + 1])
+    num_rows, num_cols = _block_shape(storage.layout, storage.num_rows, storage.num_cols, start, end)
+    return CompressedStorage(storage.layout, num_rows, num_cols, indptr,
+                             storage.indices[lo:hi], storage.data[lo:hi])
+
+
+def _patch_compressed(storage, patch, both, b_only=None):
+    # Only majors that have entries in patch are merged; the rest are copied as slices.
+    patch_indptr = patch.indptr
+    touched = compress(range(patch.num_major), map(operator.sub, islice(patch_indptr, 1, None), patch_indptr))
+    blocks = []
+    start = 0
+    for major in touched:
+        if major > start:
+            blocks.append(_slice_majors(storage, start, major))
+        end = major + 1
+        blocks.append(_merge_compressed(storage, patch, both, b_only=b_only, start=major, end=end))
+        start = end
+    if start == 0:
+        return storage
+    if start < storage.num_major:
+        blocks.append(_slice_majors(storage, start, storage.num_major))
+    return _stitch_blocks(storage.layout, storage.num_rows, storage.num_cols, blocks)
+
+
+def _multiply_symbolic(a, b, start, end):
+    a_indptr, a_indices = a.indptr, a.indices
+    b_indptr, b_indices = b.indptr, b.indices
+    marker = [-1] * b.num_cols
+    counts = []
+    for row in range(start, end):
+        count = 0
+        for k in range(a_indptr[row], a_indptr[row + 1]):
+            inner = a_indices[k]
+            for j in range(b_indptr[inner], b_indptr[inner + 1]):
+                col = b_indices[j]
+                if marker[col] != row:
+                    marker[col] = row
+                    count += 1
+        counts.append(count)
+    return counts
+
+
+def _multiply_compressed(a, b, start=0, end=None):
+    a_indptr, a_indices, a_data = a.indptr, a.indices, a.data
+    b_indptr, b_indices, b_data = b.indptr, b.indices, b.data
+    if end is None:
+        end = a.num_rows
+    counts = _multiply_symbolic(a, b, start, end)
+    indptr = _cumulative(counts)
+    nnz = indptr[-1]
+    indices = _index_buffer(bytes(8 * nnz))
+    data = [0] * nnz
+    accumulator = [0] * b.num_cols
+    marker = [-1] * b.num_cols
+    position = 0
+    for row in range(start, end):
+        cols = []
+        for k in range(a_indptr[row], a_indptr[row + 1]):
+            inner = a_indices[k]
+            a_value = a_data[k]
+            for j in range(b_indptr[inner], b_indptr[inner + 1]):
+                col = b_indices[j]
+                if marker[col] != row:
+                    marker[col] = row
+                    accumulator[col] = a_value * b_data[j]
+                    cols.append(col)
+                else:
+                    accumulator[col] += a_value * b_data[j]
+        cols.sort()
+        row_start = position
+        for col in cols:
+            value = accumulator[col]
+            if value != 0:
+                indices[position] = col
+                data[position] = value
+                position += 1
+        counts[row - start] = position - row_start
+    if position != nnz:
+        indptr = _cumulative(counts)
+        del indices[position:]
+        del data[position:]
+    return CompressedStorage("csr", end - start, b.num_cols, indptr, indices, _value_buffer(data))
+
+
+def _dense_row(storage, major, width):
+    row = [0] * width
+    lo, hi = storage.indptr[major], storage.indptr[major + 1]
+    for index, value in zip(storage.indices[lo:hi], storage.data[lo:hi]):
+        row[index] = value
+    return row
+
+
+def _merge_dense(a, b, both, start, end):
+    width = a.num_minor
+    positions = range(width)
+    counts = []
+    indices = _index_buffer()
+    data = []
+    for major in range(start, end):
+        merged = list(map(both, _dense_row(a, major, width), _dense_row(b, major, width)))
+        major_start = len(indices)
+        indices.extend(compress(positions, merged))
+        data.extend(compress(merged, merged))
+        counts.append(len(indices) - major_start)
+    num_rows, num_cols = _block_shape(a.layout, a.num_rows, a.num_cols, start, end)
+    return CompressedStorage(a.layout, num_rows, num_cols, _cumulative(counts),
+                             indices, _value_buffer(data))
+
+
+def _merge_hybrid(a, b, both, b_only, dense_rows):
+    dense_rows = set(dense_rows)
+    blocks = []
+    start = 0
+    while start < a.num_major:
+        dense = start in dense_rows
+        end = start + 1
+        while end < a.num_major and (end in dense_rows) == dense:
+            end += 1
+        if dense:
+            blocks.append(_merge_dense(a, b, both, start, end))
+        else:
+            blocks.append(_merge_compressed(a, b, both, b_only=b_only, start=start, end=end))
+        start = end
+    return _stitch_blocks(a.layout, a.num_rows, a.num_cols, blocks)
+
+
+def _multiply_hybrid(a, b, dense_rows):
+    # Contributions are summed in the same inner-index order as _multiply_compressed; the planner
+    # only picks this kernel when _padding_is_exact holds, so the results are identical.
+    a_indptr, a_indices, a_data = a.indptr, a.indices, a.data
+    b_indptr, b_indices, b_data = b.indptr, b.indices, b.data
+    width = b.num_cols
+    positions = range(width)
+    dense = {inner: _dense_row(b, inner, width) for inner in dense_rows}
+    counts = []
+    indices = _index_buffer()
+    data = []
+    accumulator = [0] * width
+    marker = [-1] * width
+    for row in range(a.num_rows):
+        dense_sum = None
+        cols = []
+        for k in range(a_indptr[row], a_indptr[row + 1]):
+            inner = a_indices[k]
+            a_value = a_data[k]
+            b_row = dense.get(inner)
+            if b_row is not None:
+                scaled = map(operator.mul, repeat(a_value), b_row)
+                if dense_sum is None and not cols:
+                    dense_sum = list(scaled)
+                    continue
+                if dense_sum is None:
+                    dense_sum = [0] * width
+                    for col in cols:
+                        dense_sum[col] = accumulator[col]
+                dense_sum = list(map(operator.add, dense_sum, scaled))
+            elif dense_sum is not None:
+                for j in range(b_indptr[inner], b_indptr[inner + 1]):
+                    dense_sum[b_indices[j]] += a_value * b_data[j]
+            else:
+                for j in range(b_indptr[inner], b_indptr[inner + 1]):
+                    col = b_indices[j]
+                    if marker[col] != row:
+                        marker[col] = row
+                        accumulator[col] = a_value * b_data[j]
+                        cols.append(col)
+                    else:
+                        accumulator[col] += a_value * b_data[j]
+        row_start = len(indices)
+        if dense_sum is None:
+            cols.sort()
+            for col in cols:
+                value = accumulator[col]
+                if value != 0:
+                    indices.append(col)
+                    data.append(value)
+        else:
+            indices.extend(compress(positions, dense_sum))
+            data.extend(compress(dense_sum, dense_sum))
+        counts.append(len(indices) - row_start)
+    return CompressedStorage("csr", a.num_rows, width, _cumulative(counts), indices, _value_buffer(data))
+
+
+def _merge_dict(a, b, both, b_only):
+    result = dict(a)
+    for key, value in b.items():
+        if key in result:
+            value = both(result[key], value)
+        elif b_only is not None:
+            value = b_only(value)
+        if value != 0:
+            result[key] = value
+        else:
+            result.pop(key, None)
+    return result
+
+
+def _dense_vector(x, size):
+    values = x.tolist() if hasattr(x, "tolist") else list(x)
+    if len(values) != size:
+        raise ValueError("Vector length does not match matrix dimensions")
+    return values
+
+
+def _dense_rows(x, num_rows=None):
+    rows = x.tolist() if hasattr(x, "tolist") else [list(row) for row in x]
+    if num_rows is not None and len(rows) != num_rows:
+        raise ValueError("Dense matrix rows do not match matrix dimensions")
+    width = len(rows[0]) if rows else 0
+    if any(len(row) != width for row in rows):
+        raise ValueError("Dense matrix rows must all have the same length")
+    return rows, width
+
+
+def _gather_vector(storage, x):
+    indptr, indices, data = storage.indptr, storage.indices, storage.data
+    lookup = x.__getitem__
+    result = []
+    for major in range(storage.num_major):
+        lo, hi = indptr[major], indptr[major + 1]
+        result.append(sum(map(operator.mul, data[lo:hi], map(lookup, indices[lo:hi]))))
+    return result
+
+
+def _scatter_vector(storage, x):
+    indptr, indices, data = storage.indptr, storage.indices, storage.data
+    result = [0] * storage.num_minor
+    for major in range(storage.num_major):
+        x_value = x[major]
+        for k in range(indptr[major], indptr[major + 1]):
+            result[indices[k]] += data[k] * x_value
+    return result
+
+
+def _gather_rows(storage, rows, width):
+    indptr, indices, data = storage.indptr, storage.indices, storage.data
+    result = []
+    for major in range(storage.num_major):
+        total = [0] * width
+        for k in range(indptr[major], indptr[major + 1]):
+            value = data[k]
+            total = [current + value * x for current, x in zip(total, rows[indices[k]])]
+        result.append(total)
+    return result
+
+
+def _scatter_rows(storage, rows, width):
+    indptr, indices, data = storage.indptr, storage.indices, storage.data
+    result = [[0] * width for _ in range(storage.num_minor)]
+    for major in range(storage.num_major):
+        row = rows[major]
+        for k in range(indptr[major], indptr[major + 1]):
+            value = data[k]
+            minor = indices[k]
+            result[minor] = [current + value * x for current, x in zip(result[minor], row)]
+    return result
+
+
+_ENTRY_LINE = re.compile(
+    r'^[ \t\r\f\v]*\([ \t]*[+-]?\d+[ \t]*,[ \t]*[+-]?\d+[ \t]*,[ \t]*[+-]?\d+[ \t]*\)[ \t\r\f\v]*$',
+    re.MULTILINE)
+_SEPARATORS = str.maketrans('(),', '   ')
+
+
+def _parse_entry_line(line, num_rows, num_cols, line_number):
+    line = line.strip()
+    if not (line.startswith('(') and line.endswith(')')):
+        raise ValueError(f"Input file has wrong format (line {line_number})")
+    try:
+        values = [int(val.strip()) for val in line[1:-1].strip().split(',')]
+    except ValueError:
+        raise ValueError(f"Input file has wrong format (line {line_number})")
+    if len(values) != 3:
+        raise ValueError(f"Input file has wrong format (line {line_number})")
+    row, col, value = values
+    if row < 0 or row >= num_rows or col < 0 or col >= num_cols:
+        raise ValueError(f"Matrix indices out of bounds: ({row}, {col}) (line {line_number})")
+    return row, col, value
+
+
+def _raise_chunk_error(chunk, first_line, num_rows, num_cols):
+    for offset, line in enumerate(chunk.split('\n')):
+        if line.strip():
+            _parse_entry_line(line, num_rows, num_cols, first_line + offset)
+    raise ValueError("Input file has wrong format")
+
+
+def _extend_values(buffer, values):
+    size = len(buffer)
+    try:
+        buffer.extend(values)
+    except (TypeError, OverflowError):
+        # array.extend keeps the items it appended before the failure.
+        del buffer[size:]
+        buffer = list(buffer)
+        buffer.extend(values)
+    return buffer
+
+
+def _read_header(file):
+    header = []
+    line_number = 0
+    while len(header) < 2:
+        line = file.readline()
+        if not line:
+            raise ValueError("Input file has wrong format")
+        line_number += 1
+        if line.strip():
+            header.append(line.strip())
+    if not header[0].startswith("rows=") or not header[1].startswith("cols="):
+        raise ValueError("Input file has wrong format")
+    try:
+        num_rows = int(header[0].split('=')[1])
+        num_cols = int(header[1].split('=')[1])
+    except (ValueError, IndexError):
+        raise ValueError("Input file has wrong format")
+    return num_rows, num_cols, line_number
+
+
+def _parse_chunk(chunk, first_line, num_rows, num_cols, rows, cols, values):
+    if _ENTRY_LINE.sub('', chunk).strip():
+        _raise_chunk_error(chunk, first_line, num_rows, num_cols)
+    numbers = list(map(int, chunk.translate(_SEPARATORS).split()))
+    if not numbers:
+        return values
+    chunk_rows = numbers[0::3]
+    chunk_cols = numbers[1::3]
+    if (min(chunk_rows) < 0 or max(chunk_rows) >= num_rows
+            or min(chunk_cols) < 0 or max(chunk_cols) >= num_cols):
+        _raise_chunk_error(chunk, first_line, num_rows, num_cols)
+    rows.extend(chunk_rows)
+    cols.extend(chunk_cols)
+    return _extend_values(values, numbers[2::3])
+
+
+def _text_chunks(file, line_number, chunk_size=READ_CHUNK_SIZE):
+    pending = ''
+    while True:
+        block = file.read(chunk_size)
+        text = pending + block
+        if block:
+            cut = text.rfind('\n') + 1
+            chunk, pending = text[:cut], text[cut:]
+        else:
+            chunk, pending = text, ''
+        if chunk:
+            yield chunk, line_number + 1
+            line_number += chunk.count('\n')
+        if not block:
+            break
+
+
+def _read_text_entries(file, chunk_size=READ_CHUNK_SIZE):
+    num_rows, num_cols, line_number = _read_header(file)
+    rows = _index_buffer()
+    cols = _index_buffer()
+    values = _value_buffer()
+    for chunk, first_line in _text_chunks(file, line_number, chunk_size):
+        values = _parse_chunk(chunk, first_line, num_rows, num_cols, rows, cols, values)
+    return num_rows, num_cols, rows, cols, values
+
+
+def _stream_text_entries(file_path, chunk_size):
+    with _open_text(file_path) as file:
+        num_rows, num_cols, line_number = _read_header(file)
+        for chunk, first_line in _text_chunks(file, line_number, chunk_size):
+            rows, cols, values = [], [], []
+            _parse_chunk(chunk, first_line, num_rows, num_cols, rows, cols, values)
+            yield from compress(zip(rows, cols, values), values)
+
+
+def _stream_binary_entries(compressed):
+    for (row, col), value in compressed.items():
+        if value:
+            yield row, col, value
+
+
+def _drop_zeros(rows, cols, values):
+    keep = list(map(bool, values))
+    if all(keep):
+        return rows, cols, values
+    return list(compress(rows, keep)), list(compress(cols, keep)), list(compress(values, keep))
+
+
+def _combine_duplicates(keys, values, duplicates, position):
+    combined = dict(zip(keys, values))
+    if len(combined) == len(keys) or duplicates == "last":
+        return combined
+    if duplicates == "error":
+        seen = set()
+        for key in keys:
+            if key in seen:
+                raise ValueError(f"Duplicate entry at {position(key)}")
+            seen.add(key)
+    # Repeated keys only hold their last value, so sum into the same dict again.
+    for key in combined:
+        combined[key] = 0
+    for key, value in zip(keys, values):
+        combined[key] += value
+    if not all(combined.values()):
+        # Zeros were dropped up front, so only cancelling sums can leave new ones.
+        combined = {key: value for key, value in combined.items() if value != 0}
+    return combined
+
+
+def _check_duplicate_policy(duplicates):
+    if duplicates not in DUPLICATE_POLICIES:
+        raise ValueError(f"Unknown duplicate policy: {duplicates}")
+
+
+def _entries_to_compressed(num_rows, num_cols, rows, cols, values, layout="csr", duplicates="last"):
+    _check_duplicate_policy(duplicates)
+    rows, cols, values = _drop_zeros(rows, cols, values)
+    keys = list(map(operator.add, map(operator.mul, rows, repeat(num_cols)), cols))
+    if not all(map(operator.lt, keys, islice(keys, 1, None))):
+        combined = _combine_duplicates(keys, values, duplicates, lambda key: divmod(key, num_cols))
+        keys = sorted(combined)
+        rows = list(map(operator.floordiv, keys, repeat(num_cols)))
+        cols = list(map(operator.mod, keys, repeat(num_cols)))
+        values = list(map(combined.__getitem__, keys))
+    compressed = CompressedStorage.from_sorted("csr", num_rows, num_cols, rows, cols, values)
+    return compressed.convert(layout)
+
+
+def _entries_to_dict(rows, cols, values, duplicates="last"):
+    _check_duplicate_policy(duplicates)
+    rows, cols, values = _drop_zeros(rows, cols, values)
+    return _combine_duplicates(list(zip(rows, cols)), values, duplicates, _identity)
+
+
+def _check_entry_bounds(num_rows, num_cols, rows, cols):
+    if not rows:
+        return
+    if min(rows) < 0 or max(rows) >= num_rows or min(cols) < 0 or max(cols) >= num_cols:
+        for row, col in zip(rows, cols):
+            if row < 0 or row >= num_rows or col < 0 or col >= num_cols:
+                raise IndexError(f"Matrix indices out of bounds: ({row}, {col})")
+
+
+def _as_list(values):
+    return values.tolist() if hasattr(values, "tolist") else list(values)
+
+
+def _unzip_entries(entries):
+    entries = list(entries)
+    return tuple(list(map(operator.itemgetter(position), entries)) for position in range(3))
+
+
+def _second(first, second):
+    return second
+
+
+def _identity(value):
+    return value
+
+
+def _zero(value):
+    return 0
+
+
+def _with_data(storage, data):
+    keep = list(map(bool, data))
+    if all(keep):
+        return CompressedStorage(storage.layout, storage.num_rows, storage.num_cols,
+                                 storage.indptr, storage.indices, _value_buffer(data))
+    indptr = storage.indptr
+    counts = [sum(keep[lo:hi]) for lo, hi in zip(indptr, islice(indptr, 1, None))]
+    return CompressedStorage(storage.layout, storage.num_rows, storage.num_cols, _cumulative(counts),
+                             _index_buffer(compress(storage.indices, keep)),
+                             _value_buffer(compress(data, keep)))
+
+
+def _major_sums(storage):
+    indptr, data = storage.indptr, storage.data
+    return [sum(data[lo:hi]) for lo, hi in zip(indptr, islice(indptr, 1, None))]
+
+
+def _minor_sums(storage):
+    sums = [0] * storage.num_minor
+    for index, value in zip(storage.indices, storage.data):
+        sums[index] += value
+    return sums
+
+
+def _open_gzip(file_path, mode):
+    return gzip.open(file_path, mode, compresslevel=6)
+
+
+def _open_xz(file_path, mode):
+    return lzma.open(file_path, mode, preset=1 if 'w' in mode else None)
+
+
+COMPRESSION_FORMATS = {
+    "gzip": (b"\x1f\x8b", _open_gzip),
+    "bz2": (b"BZh", bz2.open),
+    "xz": (b"\xfd7zXZ\x00", _open_xz),
+}
+_COMPRESSION_SUFFIXES = {".gz": "gzip", ".bz2": "bz2", ".xz": "xz"}
+
+
+def _open_text(file_path):
+    with open(file_path, 'rb') as file:
+        head = file.read(8)
+    for magic, opener in COMPRESSION_FORMATS.values():
+        if head.startswith(magic):
+            return opener(file_path, 'rt')
+    return open(file_path, 'r')
+
+
+def _output_compression(file_path, compression=None):
+    if compression is None:
+        return _COMPRESSION_SUFFIXES.get(os.path.splitext(file_path)[1])
+    if compression not in COMPRESSION_FORMATS:
+        raise ValueError(f"Unknown compression format: {compression}")
+    return compression
+
+
+def _open_output(file_path, compression=None):
+    if compression:
+        return COMPRESSION_FORMATS[compression][1](file_path, 'wt')
+    return open(file_path, 'w')
+
+
+def _read_text_file(file_path, layout="csr"):
+    with _open_text(file_path) as file:
+        entries = _read_text_entries(file)
+    return _entries_to_compressed(*entries, layout=layout)
+
+
+def _body_offset(file_path):
+    with _open_text(file_path) as file:
+        num_rows, num_cols, header_lines = _read_header(file)
+    with open(file_path, 'rb') as file:
+        for _ in range(header_lines):
+            file.readline()
+        return num_rows, num_cols, header_lines, file.tell()
+
+
+def _byte_ranges(file_path, start, size, count):
+    boundaries = [start]
+    with open(file_path, 'rb') as file:
+        for index in range(1, count):
+            file.seek(max(start + (size - start) * index // count - 1, boundaries[-1]))
+            file.readline()
+            boundaries.append(min(file.tell(), size))
+    boundaries.append(size)
+    return [(lo, hi) for lo, hi in zip(boundaries, boundaries[1:]) if lo < hi]
+
+
+def _parse_range(file_path, start, end, num_rows, num_cols, first_line):
+    with open(file_path, 'rb') as file:
+        file.seek(start)
+        text = io.TextIOWrapper(io.BytesIO(file.read(end - start)))
+    rows = _index_buffer()
+    cols = _index_buffer()
+    values = _value_buffer()
+    line_number = first_line - 1
+    for chunk, chunk_first_line in _text_chunks(text, line_number):
+        values = _parse_chunk(chunk, chunk_first_line, num_rows, num_cols, rows, cols, values)
+        line_number += chunk.count('\n')
+    return rows, cols, values, line_number - first_line + 1
+
+
+def _parse_range_task(task):
+    file_path, start, end, num_rows, num_cols, output_path = task
+    try:
+        rows, cols, values, lines = _parse_range(file_path, start, end, num_rows, num_cols, 1)
+    except ValueError:
+        return None
+    # Results travel through a file so the parent can read them straight into its arrays.
+    with open(output_path, 'wb') as file:
+        rows.tofile(file)
+        cols.tofile(file)
+        if isinstance(values, array):
+            values.tofile(file)
+        else:
+            pickle.dump(values, file)
+    return output_path, len(rows), lines, isinstance(values, array)
+
+
+def _read_text_file_parallel(file_path, workers, layout="csr"):
+    num_rows, num_cols, header_lines, body_start = _body_offset(file_path)
+    size = os.path.getsize(file_path)
+    count = max(workers * PARALLEL_BLOCKS_PER_WORKER, (size - body_start) // PARALLEL_PARSE_RANGE_BYTES)
+    ranges = _byte_ranges(file_path, body_start, size, count)
+    rows = _index_buffer()
+    cols = _index_buffer()
+    values = _value_buffer()
+    with tempfile.TemporaryDirectory() as directory:
+        tasks = [(file_path, start, end, num_rows, num_cols, os.path.join(directory, f"range{index}"))
+                 for index, (start, end) in enumerate(ranges)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_parse_range_task, tasks))
+        line_number = header_lines + 1
+        for (start, end), result in zip(ranges, results):
+            if result is None:
+                _parse_range(file_path, start, end, num_rows, num_cols, line_number)
+                raise ValueError("Input file has wrong format")
+            output_path, entries, lines, typed = result
+            with open(output_path, 'rb') as file:
+                rows.fromfile(file, entries)
+                cols.fromfile(file, entries)
+                if typed:
+                    part = _value_buffer()
+                    part.fromfile(file, entries)
+                else:
+                    part = pickle.load(file)
+            values = _extend_values(values, part)
+            line_number += lines
+    return _entries_to_compressed(num_rows, num_cols, rows, cols, values, layout=layout)
+
+
+def _is_compressed_file(file_path):
+    with open(file_path, 'rb') as file:
+        head = file.read(8)
+    return any(head.startswith(magic) for magic, _ in COMPRESSION_FORMATS.values())
+
+
+def _buffer_typecode(buffer):
+    if isinstance(buffer, array):
+        return buffer.typecode
+    if isinstance(buffer, memoryview):
+        return buffer.format
+    return None
+
+
+def _little_endian(buffer, typecode):
+    if sys.byteorder == 'little' and _buffer_typecode(buffer) == typecode:
+        return buffer
+    converted = array(typecode, buffer)
+    if sys.byteorder != 'little':
+        converted.byteswap()
+    return converted
+
+
+def _mapped_buffer(view, offset, count, typecode):
+    buffer = view[offset:offset + 8 * count]
+    if sys.byteorder == 'little':
+        return buffer.cast(typecode)
+    converted = array(typecode, bytes(buffer))
+    converted.byteswap()
+    return converted
+
+
+def is_binary_matrix_file(file_path):
+    with open(file_path, 'rb') as file:
+        return file.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+@contextmanager
+def _replacing(file_path):
+    # The destination may still be memory-mapped (saving a matrix back to the file it was loaded
+    # from), so it is only swapped out once the new contents are complete.
+    partial_path = file_path + ".partial"
+    try:
+        yield partial_path
+        os.replace(partial_path, file_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def _write_binary_file(compressed, file_path):
+    typecode = _buffer_typecode(compressed.data)
+    if typecode not in ('q', 'd'):
+        raise ValueError("Matrix values cannot be stored in binary format")
+    order = b'r' if compressed.layout == "csr" else b'c'
+    with _replacing(file_path) as partial_path, open(partial_path, 'wb') as file:
+        file.write(_BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, typecode.encode(), order,
+                                       compressed.num_rows, compressed.num_cols, compressed.nnz))
+        file.write(_little_endian(compressed.indptr, INDEX_TYPECODE))
+        file.write(_little_endian(compressed.indices, INDEX_TYPECODE))
+        file.write(_little_endian(compressed.data, typecode))
+
+
+def write_binary_stream(file_path, num_rows, num_cols, indptr, blocks, typecode='q'):
+    # blocks yields (indices, data) buffers in row order; data waits in a temporary file until
+    # every index has been written.
+    with _replacing(file_path) as partial_path, open(partial_path, 'wb') as file, \
+            tempfile.TemporaryFile() as values:
+        file.write(_BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, typecode.encode(), b'r',
+                                       num_rows, num_cols, indptr[-1]))
+        file.write(_little_endian(indptr, INDEX_TYPECODE))
+        written = 0
+        for indices, data in blocks:
+            file.write(_little_endian(indices, INDEX_TYPECODE))
+            values.write(_little_endian(data, typecode))
+            written += len(indices)
+        if written != indptr[-1]:
+            raise ValueError("Streamed entries do not match the row pointers")
+        values.seek(0)
+        shutil.copyfileobj(values, file)
+
+def _read_binary_file(file_path, layout="csr"):
+    with open(file_path, 'rb') as file:
+        header = file.read(_BINARY_HEADER.size)
+        if len(header) != _BINARY_HEADER.size:
+            raise ValueError("Input file has wrong format")
+        magic, version, typecode, order, num_rows, num_cols, nnz = _BINARY_HEADER.unpack(header)
+        if (magic != BINARY_MAGIC or version != BINARY_VERSION
+                or typecode not in (b'q', b'd') or order not in (b'r', b'c')):
+            raise ValueError("Input file has wrong format")
+        num_major = num_rows if order == b'r' else num_cols
+        expected_size = _BINARY_HEADER.size + 8 * (num_major + 1 + 2 * nnz)
+        if os.fstat(file.fileno()).st_size != expected_size:
+            raise ValueError("Input file has wrong format")
+        view = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+    offset = _BINARY_HEADER.size
+    indptr = _mapped_buffer(view, offset, num_major + 1, INDEX_TYPECODE)
+    offset += 8 * (num_major + 1)
+    indices = _mapped_buffer(view, offset, nnz, INDEX_TYPECODE)
+    offset += 8 * nnz
+    data = _mapped_buffer(view, offset, nnz, typecode.decode())
+    compressed = CompressedStorage("csr" if order == b'r' else "csc", num_rows, num_cols,
+                                   indptr, indices, data)
+    if layout is None:
+        return compressed
+    return compressed.convert(layout)
+
+
+def stream_entries(file_path, chunk_size=READ_CHUNK_SIZE):
+    if is_binary_matrix_file(file_path):
+        compressed = _read_binary_file(file_path, layout=None)
+        return compressed.num_rows, compressed.num_cols, _stream_binary_entries(compressed)
+    with _open_text(file_path) as file:
+        num_rows, num_cols, _ = _read_header(file)
+    return num_rows, num_cols, _stream_text_entries(file_path, chunk_size)
+
+
+def _block_boundaries(indptr, num_major, num_blocks):
+    total = indptr[num_major]
+    boundaries = {0, num_major}
+    for block in range(1, num_blocks):
+        boundaries.add(min(bisect.bisect_left(indptr, total * block // num_blocks), num_major))
+    return sorted(boundaries)
+
+
+def _stitch_blocks(layout, num_rows, num_cols, blocks):
+    indptr = _index_buffer([0])
+    indices = _index_buffer()
+    data = _value_buffer()
+    for block in blocks:
+        offset = indptr[-1]
+        indptr.extend(offset + pointer for pointer in block.indptr[1:])
+        indices.extend(block.indices)
+        data = _extend_values(data, block.data)
+    if isinstance(data, list):
+        data = _value_buffer(data)
+    return CompressedStorage(layout, num_rows, num_cols, indptr, indices, data)
+
+
+def _compute_block(task):
+    kernel, a_path, b_path, start, end, both, b_only = task
+    a = _read_binary_file(a_path)
+    b = _read_binary_file(b_path)
+    if kernel == "multiply":
+        return _multiply_compressed(a, b, start, end)
+    return _merge_compressed(a, b, both, b_only=b_only, start=start, end=end)
+
+
+def _run_parallel(kernel, a, b, workers, both=None, b_only=None):
+    num_cols = b.num_cols if kernel == "multiply" else a.num_cols
+    if (_buffer_typecode(a.data) not in ('q', 'd') or _buffer_typecode(b.data) not in ('q', 'd')
+            or a.num_rows < 2):
+        if kernel == "multiply":
+            return _multiply_compressed(a, b)
+        return _merge_compressed(a, b, both, b_only=b_only)
+    with tempfile.TemporaryDirectory() as directory:
+        a_path = os.path.join(directory, "a.spmx")
+        b_path = os.path.join(directory, "b.spmx")
+        _write_binary_file(a, a_path)
+        _write_binary_file(b, b_path)
+        boundaries = _block_boundaries(a.indptr, a.num_rows, workers * PARALLEL_BLOCKS_PER_WORKER)
+        tasks = [(kernel, a_path, b_path, start, end, both, b_only)
+                 for start, end in zip(boundaries, boundaries[1:])]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            blocks = list(executor.map(_compute_block, tasks))
+    return _stitch_blocks("csr", a.num_rows, num_cols, blocks)
+
+
+_active_sinks = []
+
+
+class MemorySink:
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def total_seconds(self, *operations):
+        return sum(record["seconds"] for record in self.records
+                   if not operations or record["operation"] in operations)
+
+
+class LoggingSink:
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger("sparse_matrix")
+        self.level = level
+
+    def emit(self, record):
+        self.logger.log(self.level, "%s", json.dumps(record))
+
+
+class JsonLinesSink:
+    def __init__(self, file_path):
+        self.file = open(file_path, 'a')
+
+    def emit(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class _Measurement:
+    def __init__(self, operation, track_memory):
+        self.operation = operation
+        self.track_memory = track_memory
+        if track_memory:
+            tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+
+    def finish(self, **fields):
+        record = {"operation": self.operation, "seconds": time.perf_counter() - self.start}
+        if self.track_memory:
+            record["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        record.update(fields)
+        for sink, _ in _active_sinks:
+            sink.emit(record)
+        return record
+
+
+def _begin(operation):
+    if not _active_sinks:
+        return None
+    return _Measurement(operation, any(track for _, track in _active_sinks))
+
+
+@contextmanager
+def instrument(sink, track_memory=False):
+    started_tracing = track_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    entry = (sink, track_memory)
+    _active_sinks.append(entry)
+    try:
+        yield sink
+    finally:
+        _active_sinks.remove(entry)
+        if started_tracing:
+            tracemalloc.stop()
+
+
+def _multiply_flops(a, b):
+    b_indptr = b.indptr
+    return sum(b_indptr[inner + 1] - b_indptr[inner] for inner in a.indices)
+
+
+def _dense_majors(counts, width):
+    cutoff = max(1, DENSE_ROW_THRESHOLD * width)
+    return [major for major, count in enumerate(counts) if count >= cutoff]
+
+
+def _row_counts(storage):
+    indptr = storage.indptr
+    return map(operator.sub, islice(indptr, 1, None), indptr)
+
+
+class ExecutionPlan:
+    def __init__(self, operation, kernel, shapes, nnz, dense_rows=(), workers=None):
+        self.operation = operation
+        self.kernel = kernel
+        self.shapes = shapes
+        self.nnz = nnz
+        self.dense_rows = dense_rows
+        self.workers = workers
+
+    @property
+    def densities(self):
+        return [count / (rows * cols) if rows * cols else 0.0
+                for (rows, cols), count in zip(self.shapes, self.nnz)]
+
+    def as_dict(self):
+        return {
+            "operation": self.operation,
+            "kernel": self.kernel,
+            "shapes": self.shapes,
+            "nnz": self.nnz,
+            "densities": self.densities,
+            "dense_rows": len(self.dense_rows),
+            "workers": self.workers,
+        }
+
+    def __str__(self):
+        densities = " x ".join(f"{density:.3f}" for density in self.densities)
+        text = f"{self.operation}: {self.kernel} kernel, densities {densities}"
+        if self.dense_rows:
+            whose = "B" if self.operation == "multiply" else "the result"
+            text += f", {len(self.dense_rows)} dense rows of {whose}"
+        if self.workers:
+            text += f", {self.workers} workers"
+        return text
+
+
+def _choose_kernel(dense_rows, num_rows):
+    if not dense_rows:
+        return "sparse"
+    return "dense" if len(dense_rows) == num_rows else "hybrid"
+
+
 class SparseMatrix:
-    def __init__(self, param=None):
-        self.elements = {}
+    __slots__ = ("num_rows", "num_cols", "_elements", "_packed", "_compressed", "_structured", "_indexes",
+                 "_structure")
+
+    def __init__(self, param=None, storage=None, workers=None):
+        self._elements = {}
+        self._packed = None
+        self._compressed = None
+        self._structured = None
+        self._indexes = {}
+        self._structure = None
         if isinstance(param, str):
-            self._load_from_file(param)
+            self._load_from_file(param, "csc" if storage == "csc" else "csr", workers)
+            self.set_storage(storage or "csr")
         elif isinstance(param, tuple) and len(param) == 2:
             self.num_rows, self.num_cols = param
+            self.set_storage(storage or "dict")
         else:
             raise ValueError("Invalid parameter. Expected file path or (rows, cols) tuple.")
 
-    def _load_from_file(self, file_path):
+    @classmethod
+    def load(cls, file_path, storage=None, workers=None):
+        return cls(file_path, storage, workers)
+
+    @staticmethod
+    def add_files(a_path, b_path, out_path, op="add", run_entries=None):
+        import out_of_core
+        return out_of_core.add_files(a_path, b_path, out_path, op,
+                                     run_entries or out_of_core.DEFAULT_RUN_ENTRIES)
+
+    @staticmethod
+    def multiply_files(a_path, b_path, out_path, memory_entries=None, progress=None):
+        import out_of_core
+        return out_of_core.multiply_files(a_path, b_path, out_path,
+                                          memory_entries or out_of_core.DEFAULT_MEMORY_ENTRIES, progress)
+
+    @classmethod
+    def from_coo(cls, rows, cols, values, shape, duplicates="sum", storage="csr"):
+        rows, cols, values = _as_list(rows), _as_list(cols), _as_list(values)
+        if not len(rows) == len(cols) == len(values):
+            raise ValueError("Row, column and value sequences must have the same length")
+        num_rows, num_cols = shape
+        _check_entry_bounds(num_rows, num_cols, rows, cols)
+        if storage == "dict":
+            matrix = cls(shape)
+            matrix._elements = _entries_to_dict(rows, cols, values, duplicates)
+            return matrix
+        return cls._from_compressed(_entries_to_compressed(
+            num_rows, num_cols, rows, cols, values, duplicates=duplicates)).set_storage(storage)
+
+    @classmethod
+    def from_iterable(cls, entries, shape, duplicates="sum", storage="csr"):
+        return cls.from_coo(*_unzip_entries(entries), shape, duplicates, storage)
+
+    @classmethod
+    def from_dense(cls, dense, storage="csr"):
+        dense_rows, num_cols = _dense_rows(dense)
+        rows, cols, values = [], [], []
+        for row, dense_row in enumerate(dense_rows):
+            nonzero = [col for col, value in enumerate(dense_row) if value != 0]
+            rows.extend(repeat(row, len(nonzero)))
+            cols.extend(nonzero)
+            values.extend(dense_row[col] for col in nonzero)
+        return cls._from_compressed(CompressedStorage.from_sorted(
+            "csr", len(dense_rows), num_cols, rows, cols, values)).set_storage(storage)
+
+    @classmethod
+    def _from_compressed(cls, compressed):
+        matrix = cls((compressed.num_rows, compressed.num_cols))
+        matrix._elements = None
+        matrix._compressed = compressed
+        return matrix
+
+    @classmethod
+    def _from_structured(cls, structured):
+        matrix = cls((structured.num_rows, structured.num_cols))
+        matrix._elements = None
+        matrix._structured = structured
+        return matrix
+
+    @property
+    def storage(self):
+        if self._compressed is not None:
+            return self._compressed.layout
+        if self._structured is not None:
+            return self._structured.kind
+        if self._packed is not None:
+            return "packed"
+        return "dict"
+
+    @property
+    def structure(self):
+        if self._structured is not None:
+            return self._structured.kind
+        if self._elements is not None:
+            return _detect_structure(self._as_compressed("csr"))
+        if self._structure is None:
+            self._structure = _detect_structure(self._as_compressed("csr"))
+        return self._structure
+
+    @property
+    def nnz(self):
+        if self._compressed is not None:
+            return self._compressed.nnz
+        if self._structured is not None:
+            return self._structured.nnz
+        if self._packed is not None:
+            return self._packed.nnz
+        return len(self._elements)
+
+    @property
+    def elements(self):
+        if self._elements is None:
+            self.set_storage("dict")
+        self._invalidate()
+        return self._elements
+
+    def _invalidate(self):
+        self._indexes.clear()
+        self._structure = None
+
+    def set_storage(self, storage):
+        if storage == "auto":
+            storage = self.structure if self.structure in STRUCTURED_FORMATS else "csr"
+        if storage not in STORAGE_FORMATS:
+            raise ValueError(f"Unknown storage format: {storage}")
+        if storage == self.storage:
+            return self
+        if storage in STRUCTURED_FORMATS:
+            self._structured = _structured_storage(storage, self._as_compressed("csr"))
+            self._indexes.clear()
+            self._elements = self._packed = self._compressed = None
+            return self
+        if storage in ("csr", "csc"):
+            compressed = self._as_compressed(storage)
+            if self._compressed is not None:
+                self._indexes.clear()
+            self._indexes.pop(storage, None)
+            self._compressed = compressed
+            self._elements = self._packed = self._structured = None
+            return self
+        if storage == "dict":
+            source = self._compressed or self._packed or self._structured
+            self._elements = source.to_dict()
+            self._packed = None
+            self._invalidate()
+        else:
+            self._packed = PackedStorage.from_items(self._raw_items(), self.num_rows, self.num_cols, self.nnz)
+            self._elements = None
+            if self._compressed is not None:
+                self._indexes[self._compressed.layout] = self._compressed
+        self._structured = self._compressed = None
+        return self
+
+    def freeze(self, layout="csr"):
+        if self._compressed is None and self._structured is None:
+            self.set_storage(layout)
+        return self
+
+    def _drop_structure(self):
+        if self._structured is not None:
+            self.set_storage("csr")
+
+    def _as_compressed(self, layout="csr"):
+        if self._compressed is not None and self._compressed.layout == layout:
+            return self._compressed
+        index = self._indexes.get(layout)
+        if index is None:
+            if self._compressed is not None:
+                index = self._compressed.convert(layout)
+            elif self._structured is not None:
+                index = self._structured.to_compressed(layout)
+            elif self._packed is not None:
+                index = self._packed.to_compressed(layout)
+            else:
+                # The dict handed out by elements can be edited directly, so it is never indexed.
+                return CompressedStorage.from_dict(self._elements, self.num_rows, self.num_cols, layout)
+            self._indexes[layout] = index
+        return index
+
+    def _check_bounds(self, row, col):
+        if row < 0 or row >= self.num_rows or col < 0 or col >= self.num_cols:
+            raise IndexError(f"Matrix indices out of bounds: ({row}, {col})")
+
+    def row(self, row):
+        self._check_bounds(row, 0)
+        index = self._as_compressed("csr")
+        lo, hi = index.indptr[row], index.indptr[row + 1]
+        return list(zip(index.indices[lo:hi], index.data[lo:hi]))
+
+    def col(self, col):
+        self._check_bounds(0, col)
+        index = self._as_compressed("csc")
+        lo, hi = index.indptr[col], index.indptr[col + 1]
+        return list(zip(index.indices[lo:hi], index.data[lo:hi]))
+
+    def transpose(self):
+        if self._compressed is not None:
+            compressed = self._compressed
+            return SparseMatrix._from_compressed(CompressedStorage(
+                "csc" if compressed.layout == "csr" else "csr", compressed.num_cols,
+                compressed.num_rows, compressed.indptr, compressed.indices, compressed.data))
+        if self._structured is not None:
+            return SparseMatrix._from_structured(self._structured.transpose())
+        result = SparseMatrix((self.num_cols, self.num_rows))
+        if self._packed is not None:
+            result._elements = None
+            result._packed = self._packed.transpose()
+        else:
+            result._elements = {(col, row): value for (row, col), value in self._elements.items()}
+        return result
+
+    def _raw_items(self):
+        if self._compressed is not None:
+            return self._compressed.items()
+        if self._structured is not None:
+            return self._structured.items()
+        if self._packed is not None:
+            return self._packed.items()
+        return self._elements.items()
+
+    def items(self):
+        if self._structured is not None:
+            return self._structured.items()
+        if self._elements is None:
+            return self._as_compressed("csr").items()
+        return iter(sorted(self._elements.items()))
+
+    def _load_from_file(self, file_path, layout="csr", workers=None):
+        measurement = _begin("parse")
         try:
-            with open(file_path, 'r') as file:
-                lines = [line.strip() for line in file.readlines() if line.strip()]
-                if not lines[0].startswith("rows="):
-                    raise ValueError("Input file has wrong format")
-                if not lines[1].startswith("cols="):
-                    raise ValueError("Input file has wrong format")
-                try:
-                    self.num_rows = int(lines[0].split('=')[1])
-                    self.num_cols = int(lines[1].split('=')[1])
-                except (ValueError, IndexError):
-                    raise ValueError("Input file has wrong format")
-                for i in range(2, len(lines)):
-                    line = lines[i].strip()
-                    if not (line.startswith('(') and line.endswith(')')):
-                        raise ValueError("Input file has wrong format")
-                    content = line[1:-1].strip()
-                    try:
-                        values = [int(val.strip()) for val in content.split(',')]
-                        if len(values) != 3:
-                            raise ValueError("Input file has wrong format")
-                        row, col, value = values
-                        if row < 0 or row >= self.num_rows or col < 0 or col >= self.num_cols:
-                            raise ValueError(f"Matrix indices out of bounds: ({row}, {col})")
-                        if value != 0:
-                            self.elements[(row, col)] = value
-                    except ValueError:
-                        raise ValueError("Input file has wrong format")
+            binary = is_binary_matrix_file(file_path)
+            if binary:
+                compressed = _read_binary_file(file_path, layout)
+            elif workers and workers > 1 and not _is_compressed_file(file_path):
+                compressed = _read_text_file_parallel(file_path, workers, layout)
+            else:
+                compressed = _read_text_file(file_path, layout)
         except FileNotFoundError:
             raise FileNotFoundError(f"File not found: {file_path}")
+        if measurement:
+            size_field = "bytes_mapped" if binary else "bytes_read"
+            measurement.finish(format="binary" if binary else "text",
+                               **{size_field: os.path.getsize(file_path)},
+                               output_shape=[compressed.num_rows, compressed.num_cols],
+                               output_nnz=compressed.nnz)
+        self.num_rows, self.num_cols = compressed.num_rows, compressed.num_cols
+        self._elements = None
+        self._compressed = compressed
 
     def get_element(self, row, col):
-        if row < 0 or row >= self.num_rows or col < 0 or col >= self.num_cols:
-            raise IndexError(f"Matrix indices out of bounds: ({row}, {col})")
-        return self.elements.get((row, col), 0)
+        self._check_bounds(row, col)
+        if self._compressed is not None:
+            return self._compressed.get(row, col)
+        if self._structured is not None:
+            return self._structured.get(row, col)
+        if self._packed is not None:
+            return self._packed.get(row, col)
+        return self._elements.get((row, col), 0)
 
     def set_element(self, row, col, value):
-        if row < 0 or row >= self.num_rows or col < 0 or col >= self.num_cols:
-            raise IndexError(f"Matrix indices out of bounds: ({row}, {col})")
+        self._check_bounds(row, col)
+        if self._packed is not None:
+            self._packed.set(row, col, value)
+            self._invalidate()
+            return
+        if self._elements is None:
+            self.set_storage("dict")
         if value == 0:
-            self.elements.pop((row, col), None)
+            self._elements.pop((row, col), None)
         else:
-            self.elements[(row, col)] = value
+            self._elements[(row, col)] = value
+        self._invalidate()
 
-    def add(self, other):
-        if self.num_rows != other.num_rows or self.num_cols != other.num_cols:
-            raise ValueError("Matrix dimensions do not match for addition")
-        result = SparseMatrix((self.num_rows, self.num_cols))
-        for (row, col), value in self.elements.items():
-            result.set_element(row, col, value)
-        for (row, col), value in other.elements.items():
-            current_value = result.get_element(row, col)
-            result.set_element(row, col, current_value + value)
-        return result
+    def set_elements(self, entries):
+        rows, cols, values = _unzip_entries(entries)
+        _check_entry_bounds(self.num_rows, self.num_cols, rows, cols)
+        updates = dict(zip(zip(rows, cols), values))
+        self._drop_structure()
+        self._invalidate()
+        if self._compressed is not None:
+            layout = self._compressed.layout
+            patch = CompressedStorage.from_dict(updates, self.num_rows, self.num_cols, layout)
+            self._compressed = _merge_compressed(self._compressed, patch, _second, b_only=_identity)
+            return self
+        if self._packed is not None:
+            for (row, col), value in updates.items():
+                self._packed.set(row, col, value)
+            return self
+        elements = self._elements
+        for key, value in updates.items():
+            if value == 0:
+                elements.pop(key, None)
+            else:
+                elements[key] = value
+        return self
 
-    def subtract(self, other):
+    def update_from(self, other):
+        self._check_same_shape(other, "update")
+        self._drop_structure()
+        self._invalidate()
+        if self._compressed is not None:
+            layout = self._compressed.layout
+            self._compressed = _merge_compressed(
+                self._compressed, other._as_compressed(layout), _second)
+        elif self._packed is not None:
+            for (row, col), value in list(other._raw_items()):
+                self._packed.set(row, col, value)
+        else:
+            self._elements.update(other._raw_items())
+        return self
+
+    def _check_same_shape(self, other, operation):
         if self.num_rows != other.num_rows or self.num_cols != other.num_cols:
-            raise ValueError("Matrix dimensions do not match for subtraction")
-        result = SparseMatrix((self.num_rows, self.num_cols))
-        for (row, col), value in self.elements.items():
-            result.set_element(row, col, value)
-        for (row, col), value in other.elements.items():
-            current_value = result.get_element(row, col)
-            result.set_element(row, col, current_value - value)
+            raise ValueError(f"Matrix dimensions do not match for {operation}")
+
+    def _uses_dict(self):
+        return self._elements is not None and "csr" not in self._indexes
+
+    def explain(self, operation, other, workers=None):
+        shapes = [[self.num_rows, self.num_cols], [other.num_rows, other.num_cols]]
+        nnz = [self.nnz, other.nnz]
+        parallel = workers if workers and workers > 1 else None
+        if operation in ("add", "subtract"):
+            kernel = _structured_kernel(operation, self._structured, other._structured)
+            if kernel:
+                return ExecutionPlan(operation, kernel, shapes, nnz)
+            if not parallel and self._uses_dict() and other._uses_dict():
+                return ExecutionPlan(operation, "dict", shapes, nnz)
+            a, b = self._as_compressed(), other._as_compressed()
+            if parallel:
+                return ExecutionPlan(operation, "sparse", shapes, nnz, workers=parallel)
+            counts = map(operator.add, _row_counts(a), _row_counts(b))
+            dense_rows = _dense_majors(counts, self.num_cols)
+            return ExecutionPlan(operation, _choose_kernel(dense_rows, self.num_rows), shapes, nnz, dense_rows)
+        if operation == "multiply":
+            kernel = _structured_kernel(operation, self._structured, other._structured)
+            if kernel:
+                return ExecutionPlan(operation, kernel, shapes, nnz)
+            a, b = self._as_compressed(), other._as_compressed()
+            if parallel:
+                return ExecutionPlan(operation, "sparse", shapes, nnz, workers=parallel)
+            dense_rows = _dense_majors(_row_counts(b), other.num_cols)
+            if dense_rows and not (_padding_is_exact(a) and _padding_is_exact(b)):
+                dense_rows = []
+            return ExecutionPlan(operation, _choose_kernel(dense_rows, other.num_rows), shapes, nnz, dense_rows)
+        raise ValueError(f"Unknown operation: {operation}")
+
+    def _merge(self, operation, other, both, b_only=None, workers=None):
+        measurement = _begin(operation)
+        plan = self.explain(operation, other, workers)
+        if plan.kernel in STRUCTURED_FORMATS:
+            result = SparseMatrix._from_structured(
+                _merge_structured(self._structured, other._structured, both, b_only))
+        elif plan.kernel == "dict":
+            result = SparseMatrix((self.num_rows, self.num_cols))
+            result._elements = _merge_dict(self._elements, other._elements, both, b_only)
+        else:
+            a, b = self._as_compressed(), other._as_compressed()
+            if plan.workers:
+                storage = _run_parallel("merge", a, b, workers, both, b_only)
+            elif plan.dense_rows:
+                storage = _merge_hybrid(a, b, both, b_only, plan.dense_rows)
+            else:
+                storage = _merge_compressed(a, b, both, b_only=b_only)
+            result = SparseMatrix._from_compressed(storage)
+        if measurement:
+            measurement.finish(input_shapes=plan.shapes, input_nnz=plan.nnz, output_nnz=result.nnz,
+                               kernel=plan.kernel, dense_rows=len(plan.dense_rows), workers=workers)
         return result
 
-    def multiply(self, other):
+    def add(self, other, workers=None):
+        self._check_same_shape(other, "addition")
+        return self._merge("add", other, operator.add, workers=workers)
+
+    def subtract(self, other, workers=None):
+        self._check_same_shape(other, "subtraction")
+        return self._merge("subtract", other, operator.sub, operator.neg, workers)
+
+    def _update_in_place(self, other, both, b_only=None):
+        self._drop_structure()
+        self._invalidate()
+        if self._compressed is not None:
+            layout = self._compressed.layout
+            self._compressed = _merge_compressed(
+                self._compressed, other._as_compressed(layout), both, b_only=b_only)
+            return self
+        other_items = list(other._raw_items()) if other is self else other._raw_items()
+        if self._packed is not None:
+            for (row, col), value in other_items:
+                self._packed.accumulate(row, col, value, both, b_only)
+            return self
+        elements = self._elements
+        for key, value in other_items:
+            if key in elements:
+                value = both(elements[key], value)
+            elif b_only is not None:
+                value = b_only(value)
+            if value == 0:
+                elements.pop(key, None)
+            else:
+                elements[key] = value
+        return self
+
+    def apply_delta(self, delta, subtract=False):
+        if isinstance(delta, str):
+            delta = SparseMatrix(delta)
+        self._check_same_shape(delta, "subtraction" if subtract else "addition")
+        both, b_only = (operator.sub, operator.neg) if subtract else (operator.add, None)
+        self._drop_structure()
+        if self._compressed is None:
+            return self._update_in_place(delta, both, b_only)
+        self._invalidate()
+        layout = self._compressed.layout
+        self._compressed = _patch_compressed(self._compressed, delta._as_compressed(layout), both, b_only)
+        return self
+
+    def apply_product_delta(self, left, right, left_delta=None, right_delta=None):
+        # self == left * right beforehand; afterwards self == (left + left_delta) * (right + right_delta).
+        if isinstance(left_delta, str):
+            left_delta = SparseMatrix(left_delta)
+        if isinstance(right_delta, str):
+            right_delta = SparseMatrix(right_delta)
+        if left.num_cols != right.num_rows:
+            raise ValueError("Matrix dimensions do not match for multiplication")
+        if (self.num_rows, self.num_cols) != (left.num_rows, right.num_cols):
+            raise ValueError("Matrix dimensions do not match for product update")
+        for operand, delta in ((left, left_delta), (right, right_delta)):
+            if delta is not None:
+                operand._check_same_shape(delta, "product update")
+        changes = {}
+        if left_delta is not None:
+            for (row, inner), value in left_delta._raw_items():
+                for col, right_value in right.row(inner):
+                    changes[(row, col)] = changes.get((row, col), 0) + value * right_value
+        if right_delta is not None:
+            for (inner, col), value in right_delta._raw_items():
+                for row, left_value in left.col(inner):
+                    changes[(row, col)] = changes.get((row, col), 0) + left_value * value
+            if left_delta is not None:
+                for (row, inner), value in left_delta._raw_items():
+                    for col, delta_value in right_delta.row(inner):
+                        changes[(row, col)] = changes.get((row, col), 0) + value * delta_value
+        changes = {key: value for key, value in changes.items() if value != 0}
+        if changes:
+            self.apply_delta(SparseMatrix._from_compressed(
+                CompressedStorage.from_dict(changes, self.num_rows, self.num_cols)))
+        return self
+
+    def iadd(self, other):
+        self._check_same_shape(other, "addition")
+        return self._update_in_place(other, operator.add)
+
+    def isub(self, other):
+        self._check_same_shape(other, "subtraction")
+        return self._update_in_place(other, operator.sub, operator.neg)
+
+    __add__ = add
+    __sub__ = subtract
+    __iadd__ = iadd
+    __isub__ = isub
+
+    def multiply(self, other, workers=None):
         if self.num_cols != other.num_rows:
             raise ValueError("Matrix dimensions do not match for multiplication")
-        result = SparseMatrix((self.num_rows, other.num_cols))
-        self_rows = {}
-        for (row, col), value in self.elements.items():
-            if row not in self_rows:
-                self_rows[row] = {}
-            self_rows[row][col] = value
-        other_cols = {}
-        for (row, col), value in other.elements.items():
-            if col not in other_cols:
-                other_cols[col] = {}
-            other_cols[col][row] = value
-        for row in self_rows:
-            for col in other_cols:
-                total = 0
-                for k in self_rows[row]:
-                    if k in other_cols[col]:
-                        total += self_rows[row][k] * other_cols[col][k]
-                if total != 0:
-                    result.set_element(row, col, total)
-        return result
+        measurement = _begin("multiply")
+        plan = self.explain("multiply", other, workers)
+        if plan.kernel in STRUCTURED_FORMATS:
+            result = self._multiply_structured(other)
+            if measurement:
+                measurement.finish(input_shapes=plan.shapes, input_nnz=plan.nnz, output_nnz=result.nnz,
+                                   kernel=plan.kernel, dense_rows=0, workers=workers)
+            return result
+        a, b = self._as_compressed(), other._as_compressed()
+        if plan.workers:
+            result = _run_parallel("multiply", a, b, workers)
+        elif plan.dense_rows:
+            result = _multiply_hybrid(a, b, plan.dense_rows)
+        else:
+            result = _multiply_compressed(a, b)
+        if measurement:
+            measurement.finish(input_shapes=plan.shapes, input_nnz=plan.nnz, output_nnz=result.nnz,
+                               flops=_multiply_flops(a, b), kernel=plan.kernel,
+                               dense_rows=len(plan.dense_rows), workers=workers)
+        return SparseMatrix._from_compressed(result)
+
+    def _multiply_structured(self, other):
+        a, b = self._structured, other._structured
+        if a is not None and a.kind == "diagonal":
+            if b is None or b.kind == "symmetric":
+                return SparseMatrix._from_compressed(_scale_rows(a.values, other._as_compressed()))
+            result = _scale_band(a.values, _as_band(b), rows=True)
+            if b.kind == "diagonal":
+                return SparseMatrix._from_structured(DiagonalStorage(a.num_rows, result.bands[0]))
+            return SparseMatrix._from_structured(result)
+        if b is not None and b.kind == "diagonal":
+            if a is None or a.kind == "symmetric":
+                return SparseMatrix._from_compressed(_scale_cols(self._as_compressed(), b.values))
+            return SparseMatrix._from_structured(_scale_band(b.values, a, rows=False))
+        return SparseMatrix._from_structured(_multiply_bands(a, b))
+
+    def _stored_values(self):
+        if self._compressed is not None:
+            return self._compressed.data
+        if self._structured is not None:
+            return self._as_compressed().data
+        if self._packed is not None:
+            return self._packed.stored_values()
+        return self._elements.values()
+
+    def _value_storage(self):
+        if self._compressed is not None:
+            return self._compressed
+        return self._as_compressed("csr")
+
+    def _mapped(self, function):
+        storage = self._value_storage()
+        return SparseMatrix._from_compressed(_with_data(storage, list(map(function, storage.data))))
+
+    def hadamard(self, other):
+        self._check_same_shape(other, "element-wise product")
+        result = _merge_compressed(self._as_compressed(), other._as_compressed(), operator.mul,
+                                   a_only=_zero, b_only=_zero)
+        return SparseMatrix._from_compressed(result)
 
-    def save_to_file(self, file_path):
-        with open(file_path, 'w') as file:
-            file.write(f"rows={self.num_rows}\n")
-            file.write(f"cols={self.num_cols}\n")
-            sorted_elements = sorted(self.elements.items(), key=lambda x: (x[0][0], x[0][1]))
-            for (row, col), value in sorted_elements:
-                file.write(f"({row}, {col}, {value})\n")
+    def scale(self, factor):
+        storage = self._value_storage()
+        data = list(map(operator.mul, storage.data, repeat(factor)))
+        return SparseMatrix._from_compressed(_with_data(storage, data))
+
+    def map_values(self, function):
+        return self._mapped(function)
+
+    def row_sums(self):
+        return _major_sums(self._as_compressed("csr"))
+
+    def col_sums(self):
+        if self.storage == "csc" or "csc" in self._indexes:
+            return _major_sums(self._as_compressed("csc"))
+        return _minor_sums(self._as_compressed("csr"))
+
+    def nnz_per_row(self):
+        return list(_row_counts(self._as_compressed("csr")))
+
+    def trace(self):
+        if self._elements is not None:
+            elements = self._elements
+            return sum(elements.get((i, i), 0) for i in range(min(self.num_rows, self.num_cols)))
+        storage = self._compressed or self._structured or self._packed
+        return sum(storage.get(i, i) for i in range(min(self.num_rows, self.num_cols)))
+
+    def norm(self, ord="fro"):
+        if ord == "fro":
+            values = self._stored_values()
+            return math.sqrt(sum(map(operator.mul, values, values)))
+        if ord == 1:
+            return max(self._mapped(abs).col_sums(), default=0)
+        if ord == math.inf:
+            return max(self._mapped(abs).row_sums(), default=0)
+        raise ValueError(f"Unknown norm order: {ord}")
+
+    def _extreme(self, function):
+        if not self.num_rows or not self.num_cols:
+            raise ValueError("Matrix has no elements")
+        if not self.nnz:
+            return 0
+        value = function(self._stored_values())
+        if self.nnz < self.num_rows * self.num_cols:
+            return function(value, 0)
+        return value
+
+    def max(self):
+        return self._extreme(max)
+
+    def min(self):
+        return self._extreme(min)
+
+    def _read_storage(self):
+        if self._compressed is not None:
+            return self._compressed
+        return self._as_compressed("csr")
+
+    def matvec(self, x):
+        x = _dense_vector(x, self.num_cols)
+        structured = self._structured
+        if structured is not None and (structured.kind != "banded" or _padding_is_exact(structured, x)):
+            return structured.matvec(x)
+        storage = self._read_storage()
+        if storage.layout == "csr":
+            return _gather_vector(storage, x)
+        return _scatter_vector(storage, x)
+
+    def rmatvec(self, x):
+        x = _dense_vector(x, self.num_rows)
+        storage = self._read_storage()
+        if storage.layout == "csc":
+            return _gather_vector(storage, x)
+        return _scatter_vector(storage, x)
+
+    def matmat(self, x):
+        rows, width = _dense_rows(x, self.num_cols)
+        storage = self._read_storage()
+        if storage.layout == "csr":
+            return _gather_rows(storage, rows, width)
+        return _scatter_rows(storage, rows, width)
+
+    def _finish_save(self, measurement, file_path, file_format):
+        if measurement:
+            measurement.finish(format=file_format, bytes_written=os.path.getsize(file_path),
+                               input_shapes=[[self.num_rows, self.num_cols]], input_nnz=[self.nnz])
+
+    def _formatted_chunks(self, batch_entries=WRITE_BATCH_ENTRIES):
+        if self._elements is not None:
+            items = sorted(self._elements.items())
+            for start in range(0, len(items), batch_entries):
+                yield ''.join([f"({row}, {col}, {value})\n"
+                               for (row, col), value in items[start:start + batch_entries]])
+            return
+        if self._structured is not None:
+            entries = self._structured.entries()
+            while True:
+                lines = [f"({row}, {col}, {value})\n" for row, col, value in islice(entries, batch_entries)]
+                if not lines:
+                    return
+                yield ''.join(lines)
+        storage = self._as_compressed("csr")
+        indptr, indices, data = storage.indptr, storage.indices, storage.data
+        lines = []
+        for row in range(storage.num_rows):
+            lo, hi = indptr[row], indptr[row + 1]
+            if lo == hi:
+                continue
+            prefix = f"({row}, "
+            lines += [f"{prefix}{col}, {value})\n" for col, value in zip(indices[lo:hi], data[lo:hi])]
+            if len(lines) >= batch_entries:
+                yield ''.join(lines)
+                lines = []
+        if lines:
+            yield ''.join(lines)
+
+    def save_to_file(self, file_path, compression=None):
+        measurement = _begin("save")
+        compression = _output_compression(file_path, compression)
+        with _replacing(file_path) as partial_path, _open_output(partial_path, compression) as file:
+            file.write(f"rows={self.num_rows}\ncols={self.num_cols}\n")
+            for chunk in self._formatted_chunks():
+                file.write(chunk)
+        self._finish_save(measurement, file_path, "text")
+
+    def save_binary(self, file_path):
+        measurement = _begin("save")
+        _write_binary_file(self._as_compressed(), file_path)
+        self._finish_save(measurement, file_path, "binary")
 
     def __str__(self):
-        s = f"SparseMatrix: {self.num_rows}x{self.num_cols}, {len(self.elements)} non-zero elements\n"
+        s = f"SparseMatrix: {self.num_rows}x{self.num_cols}, {self.nnz} non-zero elements\n"
         if self.num_rows <= 10 and self.num_cols <= 10:
             for i in range(self.num_rows):
                 row = []
@@ -116,15 +2436,52 @@ class SparseMatrix:
                     row.append(str(self.get_element(i, j)))
                 s += " ".join(row) + "\n"
         else:
-            sorted_elements = sorted(self.elements.items(), key=lambda x: (x[0][0], x[0][1]))
-            for (row, col), value in sorted_elements:
-                s += f"({row}, {col}): {value}\n"
-                if len(sorted_elements) > 10 and sorted_elements.index(((row, col))) == 9:
+            for index, ((row, col), value) in enumerate(self.items()):
+                if index == 10:
                     s += "...\n"
                     break
+                s += f"({row}, {col}): {value}\n"
         return s
 
 
+def axpby(alpha, a, beta, b):
+    a._check_same_shape(b, "addition")
+    return SparseMatrix._from_compressed(_merge_compressed(
+        a._as_compressed(), b._as_compressed(),
+        lambda x, y: alpha * x + beta * y,
+        lambda x: alpha * x,
+        lambda y: beta * y))
+
+
+def linear_combination(terms):
+    terms = list(terms)
+    if not terms:
+        raise ValueError("At least one matrix is required")
+    first = terms[0][1]
+    for _, matrix in terms[1:]:
+        first._check_same_shape(matrix, "addition")
+    measurement = _begin("sum")
+    storages = [(coefficient, matrix._as_compressed()) for coefficient, matrix in terms]
+    result = _sum_compressed(storages, first.num_rows, first.num_cols)
+    if measurement:
+        measurement.finish(input_shapes=[[first.num_rows, first.num_cols]] * len(storages),
+                           input_nnz=[storage.nnz for _, storage in storages],
+                           output_nnz=result.nnz)
+    return SparseMatrix._from_compressed(result)
+
+
+def convert_matrix_file(source_path, destination_path, binary=None, compression=None):
+    source_is_binary = is_binary_matrix_file(source_path)
+    if binary is None:
+        binary = not source_is_binary
+    matrix = SparseMatrix(source_path)
+    if binary:
+        matrix.save_binary(destination_path)
+    else:
+        matrix.save_to_file(destination_path, compression)
+    return matrix
+
+
 def main():
     print("Sparse Matrix Operations")
     print("========================")
@@ -1,7 +1,20 @@
+import json
+import math
+import out_of_core
+import shutil
 import unittest
 import os
+import random
 import tempfile
-from sparse_matrix import SparseMatrix
+import threading
+from benchmark import build_cases, compare_to_baseline, run_benchmarks
+from main import run_batch
+from create_sample_matrices import STRUCTURES, SyntheticMatrix
+from matrix_cache import MatrixCache, file_digest
+from matrix_expression import Expression
+from matrix_service import MatrixClient, run_server
+from sparse_matrix import (STRUCTURED_FORMATS, JsonLinesSink, MemorySink, SparseMatrix, axpby, convert_matrix_file,
+                           instrument, is_binary_matrix_file, linear_combination)
 
 class TestSparseMatrix(unittest.TestCase):
     
@@ -176,5 +189,812 @@ class TestSparseMatrix(unittest.TestCase):
         self.assertEqual(result.num_cols, 4)
 
 
+    def test_compressed_storage(self):
+        matrix = SparseMatrix(self.sample_file_1)
+        self.assertEqual(matrix.storage, "csr")
+        self.assertEqual(matrix.nnz, 4)
+        self.assertEqual(matrix.get_element(0, 2), 8)
+        self.assertEqual(matrix.get_element(2, 2), 0)
+
+        matrix.set_storage("csc")
+        self.assertEqual(matrix.storage, "csc")
+        self.assertEqual(matrix.get_element(2, 0), 6)
+        self.assertEqual(list(matrix.items()), [((0, 0), 5), ((0, 2), 8), ((1, 1), 3), ((2, 0), 6)])
+
+        self.assertEqual(matrix.elements, {(0, 0): 5, (0, 2): 8, (1, 1): 3, (2, 0): 6})
+        self.assertEqual(matrix.storage, "dict")
+
+    def test_mixed_storage_operations(self):
+        matrix1 = SparseMatrix(self.sample_file_1, storage="csc")
+        matrix2 = SparseMatrix(self.sample_file_2, storage="dict")
+
+        self.assertEqual(dict(matrix1.add(matrix2).items()),
+                         {(0, 0): 7, (0, 2): 8, (1, 0): 4, (1, 1): 4, (2, 0): 6, (2, 2): 7})
+        self.assertEqual(dict(matrix1.multiply(matrix2).items()),
+                         {(0, 0): 10, (0, 2): 56, (1, 0): 12, (1, 1): 3, (2, 0): 12})
+
+        result = matrix1.subtract(matrix1)
+        self.assertEqual(result.nnz, 0)
+        result.set_element(1, 1, 9)
+        self.assertEqual(result.get_element(1, 1), 9)
+
+
+    def test_rectangular_multiplication_drops_cancellations(self):
+        matrix1 = SparseMatrix((2, 3))
+        matrix1.set_element(0, 0, 1)
+        matrix1.set_element(0, 1, 1)
+        matrix1.set_element(1, 2, 2)
+        matrix2 = SparseMatrix((3, 4))
+        matrix2.set_element(0, 3, 5)
+        matrix2.set_element(1, 3, -5)
+        matrix2.set_element(1, 0, 4)
+        matrix2.set_element(2, 1, 3)
+
+        result = matrix1.multiply(matrix2)
+
+        self.assertEqual((result.num_rows, result.num_cols), (2, 4))
+        self.assertEqual(dict(result.items()), {(0, 0): 4, (1, 1): 6})
+        self.assertEqual(result.nnz, 2)
+
+
+    def test_load_unsorted_entries(self):
+        with open(self.output_file, 'w') as f:
+            f.write("rows=3\n")
+            f.write("cols=3\n")
+            f.write("(2, 1, 4)\n")
+            f.write("(0, 2, 1)\n")
+            f.write("(2, 1, 9)\n")
+            f.write("(1, 0, 0)\n")
+            f.write("(0, 2, 0)\n")
+        matrix = SparseMatrix(self.output_file)
+
+        self.assertEqual(list(matrix.items()), [((0, 2), 1), ((2, 1), 9)])
+
+    def test_load_out_of_bounds(self):
+        with open(self.output_file, 'w') as f:
+            f.write("rows=3\n")
+            f.write("cols=3\n")
+            f.write("(0, 0, 5)\n")
+            f.write("(3, 0, 1)\n")
+        with self.assertRaises(ValueError):
+            SparseMatrix(self.output_file)
+
+
+    def test_binary_round_trip(self):
+        matrix = SparseMatrix(self.sample_file_1)
+        matrix.save_binary(self.output_file)
+
+        self.assertTrue(is_binary_matrix_file(self.output_file))
+        loaded_matrix = SparseMatrix.load(self.output_file)
+        self.assertEqual((loaded_matrix.num_rows, loaded_matrix.num_cols), (3, 3))
+        self.assertEqual(list(loaded_matrix.items()), list(matrix.items()))
+        self.assertEqual(loaded_matrix.get_element(2, 0), 6)
+
+        loaded_csc = SparseMatrix(self.output_file, storage="csc")
+        self.assertEqual(loaded_csc.get_element(0, 2), 8)
+        del loaded_matrix, loaded_csc
+
+    def test_convert_matrix_file(self):
+        binary_file = os.path.join(self.test_dir, "matrix1.bin")
+        convert_matrix_file(self.sample_file_1, binary_file)
+        self.assertTrue(is_binary_matrix_file(binary_file))
+
+        convert_matrix_file(binary_file, self.output_file)
+        os.remove(binary_file)
+        self.assertFalse(is_binary_matrix_file(self.output_file))
+        with open(self.output_file) as converted, open(self.sample_file_1) as original:
+            self.assertEqual(converted.read(), original.read())
+
+    def test_save_to_own_file(self):
+        binary_file = os.path.join(self.test_dir, "own.bin")
+        original = list(SparseMatrix(self.sample_file_1).items())
+        SparseMatrix(self.sample_file_1).save_binary(binary_file)
+        matrix = SparseMatrix(binary_file)
+        matrix.save_binary(binary_file)
+        self.assertEqual(list(SparseMatrix(binary_file).items()), original)
+
+        convert_matrix_file(binary_file, binary_file, binary=True)
+        self.assertEqual(list(SparseMatrix(binary_file).items()), original)
+        matrix.save_to_file(binary_file)
+        self.assertFalse(is_binary_matrix_file(binary_file))
+        self.assertEqual(list(matrix.items()), original)
+        self.assertEqual(list(SparseMatrix(binary_file).items()), original)
+        self.assertFalse(os.path.exists(binary_file + ".partial"))
+        os.remove(binary_file)
+
+
+    def test_in_place_addition_and_subtraction(self):
+        matrix1 = SparseMatrix(self.sample_file_1)
+        matrix2 = SparseMatrix(self.sample_file_2)
+
+        matrix = matrix1
+        matrix += matrix2
+        self.assertIs(matrix, matrix1)
+        self.assertEqual(dict(matrix.items()),
+                         {(0, 0): 7, (0, 2): 8, (1, 0): 4, (1, 1): 4, (2, 0): 6, (2, 2): 7})
+
+        matrix -= matrix2
+        self.assertEqual(dict(matrix.items()), {(0, 0): 5, (0, 2): 8, (1, 1): 3, (2, 0): 6})
+
+        matrix3 = SparseMatrix((3, 3))
+        matrix3.set_element(0, 0, -5)
+        matrix3.iadd(matrix1)
+        self.assertNotIn((0, 0), matrix3.elements)
+        matrix3.isub(matrix2)
+        self.assertEqual(matrix3.get_element(1, 0), -4)
+
+    def test_axpby(self):
+        matrix1 = SparseMatrix(self.sample_file_1)
+        matrix2 = SparseMatrix(self.sample_file_2)
+
+        result = axpby(2, matrix1, -3, matrix2)
+
+        self.assertEqual(dict(result.items()),
+                         {(0, 0): 4, (0, 2): 16, (1, 0): -12, (1, 1): 3, (2, 0): 12, (2, 2): -21})
+        self.assertEqual(axpby(0, matrix1, 0, matrix2).nnz, 0)
+
+
+    def test_parallel_operations_match_serial(self):
+        matrix1 = SparseMatrix(self.sample_file_1)
+        matrix2 = SparseMatrix(self.sample_file_2)
+
+        self.assertEqual(list(matrix1.add(matrix2, workers=2).items()),
+                         list(matrix1.add(matrix2).items()))
+        self.assertEqual(list(matrix1.subtract(matrix2, workers=2).items()),
+                         list(matrix1.subtract(matrix2).items()))
+        self.assertEqual(list(matrix1.multiply(matrix2, workers=2).items()),
+                         list(matrix1.multiply(matrix2).items()))
+
+
+    def test_linear_combination(self):
+        matrix1 = SparseMatrix(self.sample_file_1)
+        matrix2 = SparseMatrix(self.sample_file_2)
+
+        result = linear_combination([(1, matrix1), (1, matrix2), (-1, matrix1)])
+
+        self.assertEqual(list(result.items()), list(matrix2.items()))
+        with self.assertRaises(ValueError):
+            linear_combination([(1, matrix1), (1, SparseMatrix((3, 4)))])
+
+    def test_expression_evaluation(self):
+        operands = {"A": SparseMatrix(self.sample_file_1), "B": SparseMatrix(self.sample_file_2)}
+        operands["C"] = operands["A"].multiply(operands["B"])
+        expected = operands["C"].add(operands["A"]).subtract(operands["B"])
+
+        expression = Expression("A*B + A - (B + C) + C")
+
+        self.assertEqual(expression.names, {"A", "B", "C"})
+        self.assertEqual(list(expression.evaluate(operands).items()), list(expected.items()))
+        self.assertEqual(expression.plan(operands), "sum((A * B) + A - B - C + C)")
+        with self.assertRaises(ValueError):
+            Expression("A * (B + C")
+        with self.assertRaises(ValueError):
+            Expression("A + D").evaluate(operands)
+
+    def test_expression_chain_order(self):
+        operands = {"A": SparseMatrix((50, 2)), "B": SparseMatrix((2, 50)), "C": SparseMatrix((50, 1))}
+        for i in range(50):
+            operands["A"].set_element(i, i % 2, 1)
+            operands["B"].set_element(i % 2, i, 1)
+            operands["C"].set_element(i, 0, 1)
+
+        expression = Expression("A * B * C")
+
+        self.assertEqual(expression.plan(operands), "(A * (B * C))")
+        result = expression.evaluate(operands)
+        self.assertEqual(list(result.items()),
+                         list(operands["A"].multiply(operands["B"]).multiply(operands["C"]).items()))
+
+
+    def test_benchmark_report_and_baseline(self):
+        cases = build_cases([20], [0.05], operations=["add", "multiply", "transpose"], shapes=["square"])
+        report = run_benchmarks(cases, repeat=1, isolate=False)
+
+        self.assertEqual([result["key"] for result in report["results"]],
+                         ["add/square/20/0.05", "multiply/square/20/0.05", "transpose/square/20/0.05"])
+        self.assertEqual(report["results"][0]["nnz"], [20, 20])
+        self.assertEqual(compare_to_baseline(report, report), [])
+
+        slower = {"results": [dict(result, seconds_median=result["seconds_median"] * 2)
+                              for result in report["results"]]}
+        self.assertEqual(len(compare_to_baseline(slower, report, threshold=0.5)), 3)
+
+
+    def test_dense_products(self):
+        matrix = SparseMatrix(self.sample_file_1)
+
+        for storage in ("csr", "csc", "dict"):
+            matrix.set_storage(storage)
+            self.assertEqual(matrix.matvec([1, 2, 3]), [29, 6, 6])
+            self.assertEqual(matrix.rmatvec((1, 2, 3)), [23, 6, 8])
+            self.assertEqual(matrix.matmat([[1, 0], [2, 1], [3, 0]]), [[29, 0], [6, 3], [6, 0]])
+
+        with self.assertRaises(ValueError):
+            matrix.matvec([1, 2])
+        with self.assertRaises(ValueError):
+            matrix.matmat([[1, 0], [2], [3, 0]])
+
+
+    def test_instrumentation(self):
+        with instrument(MemorySink(), track_memory=True) as metrics:
+            matrix1 = SparseMatrix(self.sample_file_1)
+            matrix2 = SparseMatrix(self.sample_file_2)
+            matrix1.add(matrix2)
+            result = matrix1.multiply(matrix2)
+            result.save_to_file(self.output_file)
+        result.subtract(matrix2)
+
+        operations = [record["operation"] for record in metrics.records]
+        self.assertEqual(operations, ["parse", "parse", "add", "multiply", "save"])
+        parse, _, add, multiply, save = metrics.records
+        self.assertEqual(parse["bytes_read"], os.path.getsize(self.sample_file_1))
+        self.assertEqual(parse["output_nnz"], 4)
+        self.assertEqual(add["input_nnz"], [4, 4])
+        self.assertEqual(add["output_nnz"], 6)
+        self.assertEqual(multiply["flops"], 5)
+        self.assertEqual(save["bytes_written"], os.path.getsize(self.output_file))
+        self.assertIn("peak_memory_bytes", save)
+        self.assertGreaterEqual(metrics.total_seconds(), metrics.total_seconds("parse"))
+
+    def test_json_lines_sink(self):
+        metrics_file = os.path.join(self.test_dir, "metrics.jsonl")
+        sink = JsonLinesSink(metrics_file)
+        with instrument(sink):
+            SparseMatrix(self.sample_file_1)
+        sink.close()
+
+        with open(metrics_file) as f:
+            records = [json.loads(line) for line in f]
+        os.remove(metrics_file)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["operation"], "parse")
+
+
+    def test_matrix_cache(self):
+        cache = MatrixCache()
+        matrix = cache.load(self.sample_file_1)
+        again = cache.load(self.sample_file_1)
+
+        self.assertEqual(list(again.items()), list(matrix.items()))
+        self.assertEqual(cache.stats["hits"], 1)
+        self.assertEqual(cache.stats["misses"], 1)
+
+        again.set_element(0, 0, 1)
+        self.assertEqual(cache.load(self.sample_file_1).get_element(0, 0), 5)
+
+        with open(self.sample_file_1, 'a') as f:
+            f.write("(2, 2, 9)\n")
+        self.assertEqual(cache.load(self.sample_file_1).get_element(2, 2), 9)
+        self.assertEqual(cache.stats["invalidations"], 1)
+
+    def test_matrix_cache_eviction_and_sidecar(self):
+        cache_dir = os.path.join(self.test_dir, "cache")
+        cache = MatrixCache(max_bytes=150, cache_dir=cache_dir)
+        cache.load(self.sample_file_1)
+        cache.load(self.sample_file_2)
+        self.assertEqual(cache.stats["evictions"], 1)
+        self.assertEqual(cache.stats["entries"], 1)
+
+        fresh_cache = MatrixCache(cache_dir=cache_dir)
+        matrix = fresh_cache.load(self.sample_file_1, storage="dict")
+        self.assertEqual(fresh_cache.stats["disk_hits"], 1)
+        self.assertEqual(matrix.elements, {(0, 0): 5, (0, 2): 8, (1, 1): 3, (2, 0): 6})
+        del matrix
+        shutil.rmtree(cache_dir)
+
+    def test_matrix_cache_sidecar_write_failure(self):
+        cache_dir = os.path.join(self.test_dir, "cache")
+        cache = MatrixCache(cache_dir=cache_dir)
+        sidecar = cache._sidecar_path(file_digest(self.sample_file_1), "csr")
+        replace = os.replace
+
+        def failing_replace(source, destination):
+            if destination == sidecar:
+                raise OSError("No space left on device")
+            replace(source, destination)
+
+        os.replace = failing_replace
+        try:
+            matrix = cache.load(self.sample_file_1)
+        finally:
+            os.replace = replace
+        self.assertEqual(matrix.get_element(2, 0), 6)
+        self.assertEqual(os.listdir(cache_dir), [])
+        shutil.rmtree(cache_dir)
+
+
+    def test_transpose(self):
+        for storage in ("csr", "csc", "dict"):
+            matrix = SparseMatrix(self.sample_file_1, storage=storage)
+            transposed = matrix.transpose()
+
+            self.assertEqual((transposed.num_rows, transposed.num_cols), (3, 3))
+            self.assertEqual(dict(transposed.items()), {(0, 0): 5, (2, 0): 8, (1, 1): 3, (0, 2): 6})
+
+        rectangular = SparseMatrix((2, 5))
+        rectangular.set_element(1, 4, 7)
+        transposed = rectangular.transpose()
+        self.assertEqual((transposed.num_rows, transposed.num_cols), (5, 2))
+        self.assertEqual(transposed.get_element(4, 1), 7)
+
+    def test_row_and_col_views(self):
+        matrix = SparseMatrix(self.sample_file_1, storage="dict")
+
+        self.assertEqual(matrix.row(0), [(0, 5), (2, 8)])
+        self.assertEqual(matrix.col(0), [(0, 5), (2, 6)])
+        self.assertEqual(matrix.row(1), [(1, 3)])
+
+        matrix.set_element(1, 0, 4)
+        self.assertEqual(matrix.row(1), [(0, 4), (1, 3)])
+        self.assertEqual(matrix.col(0), [(0, 5), (1, 4), (2, 6)])
+        matrix.set_element(0, 2, 0)
+        self.assertEqual(matrix.row(0), [(0, 5)])
+        with self.assertRaises(IndexError):
+            matrix.row(3)
+
+    def test_edit_through_held_elements(self):
+        matrix = SparseMatrix((3, 3))
+        expected = SparseMatrix((3, 3))
+        for index in range(3):
+            matrix.set_element(index, index, index + 1)
+            expected.set_element(index, index, index + 1)
+        other = SparseMatrix(self.sample_file_2)
+        elements = matrix.elements
+        self.assertEqual(matrix.structure, "diagonal")
+        matrix.multiply(other)
+        matrix.row(0)
+        elements[(0, 0)] = 5
+        elements[(0, 2)] = 1
+        expected.set_element(0, 0, 5)
+        expected.set_element(0, 2, 1)
+        self.assertEqual(list(matrix.multiply(other).items()), list(expected.multiply(other).items()))
+        self.assertEqual(matrix.row(0), [(0, 5), (2, 1)])
+        self.assertEqual(list(matrix.transpose().items()), list(expected.transpose().items()))
+        self.assertEqual(matrix.structure, "upper-triangular")
+        del elements[(0, 2)]
+        self.assertEqual(matrix.col(2), [(2, 3)])
+
+    def test_bulk_construction(self):
+        matrix = SparseMatrix.from_coo([2, 0, 2, 1, 0], [1, 2, 1, 1, 0], [4, 8, 5, 0, 5], (3, 3))
+        self.assertEqual(list(matrix.items()), [((0, 0), 5), ((0, 2), 8), ((2, 1), 9)])
+
+        last = SparseMatrix.from_coo([2, 2], [1, 1], [4, 5], (3, 3), duplicates="last", storage="dict")
+        self.assertEqual(last.elements, {(2, 1): 5})
+        cancelled = SparseMatrix.from_iterable([(1, 1, 2), (1, 1, -2)], (3, 3))
+        self.assertEqual(cancelled.nnz, 0)
+        with self.assertRaises(ValueError):
+            SparseMatrix.from_coo([2, 2], [1, 1], [4, 5], (3, 3), duplicates="error")
+        with self.assertRaises(IndexError):
+            SparseMatrix.from_coo([0, 3], [0, 0], [1, 1], (3, 3))
+
+        dense = SparseMatrix.from_dense([[5, 0, 8], [0, 3, 0], [6, 0, 0]])
+        self.assertEqual(list(dense.items()), list(SparseMatrix(self.sample_file_1).items()))
+
+    def test_bulk_mutation(self):
+        for storage in ("csr", "dict"):
+            matrix = SparseMatrix(self.sample_file_1, storage=storage)
+            matrix.set_elements([(0, 0, 1), (1, 2, 7), (0, 2, 0), (1, 2, 9)])
+            self.assertEqual(dict(matrix.items()), {(0, 0): 1, (1, 1): 3, (1, 2): 9, (2, 0): 6})
+
+            matrix.update_from(SparseMatrix(self.sample_file_2))
+            self.assertEqual(dict(matrix.items()),
+                             {(0, 0): 2, (1, 0): 4, (1, 1): 1, (1, 2): 9, (2, 0): 6, (2, 2): 7})
+            with self.assertRaises(IndexError):
+                matrix.set_elements([(0, 0, 1), (0, 3, 1)])
+
+    def test_add_files(self):
+        expected_sum = SparseMatrix(self.sample_file_1).add(SparseMatrix(self.sample_file_2))
+        count = SparseMatrix.add_files(self.sample_file_1, self.sample_file_2, self.output_file)
+        self.assertEqual(count, expected_sum.nnz)
+        self.assertEqual(list(SparseMatrix(self.output_file).items()), list(expected_sum.items()))
+
+        unsorted_file = os.path.join(self.test_dir, "unsorted.txt")
+        with open(unsorted_file, 'w') as f:
+            f.write("rows=3\ncols=3\n(2, 2, 7)\n(0, 0, 1)\n(1, 1, 1)\n(0, 0, 2)\n(1, 0, 4)\n")
+        SparseMatrix.add_files(self.sample_file_1, unsorted_file, self.output_file, "subtract",
+                               run_entries=2)
+        expected_difference = SparseMatrix(self.sample_file_1).subtract(SparseMatrix(unsorted_file))
+        self.assertEqual(list(SparseMatrix(self.output_file).items()), list(expected_difference.items()))
+        os.remove(unsorted_file)
+
+        with self.assertRaises(ValueError):
+            SparseMatrix.add_files(self.sample_file_1, self.sample_file_2, self.output_file, "multiply")
+
+    def test_multiply_files(self):
+        expected = SparseMatrix(self.sample_file_1).multiply(SparseMatrix(self.sample_file_2))
+        events = []
+        count = SparseMatrix.multiply_files(self.sample_file_1, self.sample_file_2, self.output_file,
+                                            memory_entries=2, progress=lambda *event: events.append(event))
+        self.assertEqual(count, expected.nnz)
+        self.assertEqual(list(SparseMatrix(self.output_file).items()), list(expected.items()))
+        self.assertEqual(events[0], ("partition", 1, 2))
+        self.assertEqual(events[-1][0], "merge")
+        self.assertGreater(len([event for event in events if event[0] == "multiply"]), 1)
+
+        SparseMatrix((2, 2)).save_to_file(self.output_file)
+        with self.assertRaises(ValueError):
+            SparseMatrix.multiply_files(self.output_file, self.sample_file_1, self.output_file)
+        with self.assertRaises(ValueError):
+            SparseMatrix.multiply_files(self.sample_file_1, self.output_file, self.output_file)
+
+    def test_compressed_text_files(self):
+        matrix = SparseMatrix(self.sample_file_1)
+        for compression, suffix in (("gzip", ".gz"), ("bz2", ".bz2"), ("xz", ".xz")):
+            path = os.path.join(self.test_dir, "matrix.txt" + suffix)
+            matrix.save_to_file(path)
+            self.assertEqual(list(SparseMatrix(path).items()), list(matrix.items()))
+            matrix.save_to_file(self.output_file, compression=compression)
+            with open(self.output_file, 'rb') as f, open(path, 'rb') as g:
+                self.assertEqual(f.read(3)[:2], g.read(3)[:2])
+            self.assertEqual(list(SparseMatrix(self.output_file).items()), list(matrix.items()))
+            os.remove(path)
+        with self.assertRaises(ValueError):
+            matrix.save_to_file(self.output_file, compression="zip")
+
+    def test_save_to_file_storage_orders(self):
+        with open(self.sample_file_1) as f:
+            expected = f.read()
+        for storage in ("csr", "csc", "dict"):
+            SparseMatrix(self.sample_file_1, storage=storage).save_to_file(self.output_file)
+            with open(self.output_file) as f:
+                self.assertEqual(f.read(), expected)
+
+    def test_execution_plan(self):
+        sparse = SparseMatrix.from_coo([0, 2, 7], [0, 9, 3], [1, 2, 3], (10, 10))
+        dense = SparseMatrix.from_dense([[1, 2, 0, 3], [0, 0, 0, 0], [4, 5, 6, 0], [0, 7, 0, 8]])
+        self.assertEqual(sparse.explain("add", sparse).kernel, "sparse")
+        self.assertEqual(dense.explain("multiply", dense).kernel, "hybrid")
+        self.assertEqual(dense.explain("multiply", dense).dense_rows, [0, 2, 3])
+        self.assertEqual(dense.explain("add", dense.transpose()).kernel, "dense")
+        self.assertEqual(SparseMatrix((4, 4)).explain("add", SparseMatrix((4, 4))).kernel, "dict")
+        self.assertIn("hybrid kernel", str(dense.explain("multiply", dense)))
+        with self.assertRaises(ValueError):
+            dense.explain("divide", dense)
+
+        values = [[1, 2, 0, 3], [0, 0, 0, 0], [4, 5, 6, 0], [0, 7, 0, 8]]
+        expected = [[sum(values[i][k] * values[k][j] for k in range(4)) for j in range(4)] for i in range(4)]
+        self.assertEqual(list(dense.multiply(dense).items()),
+                         list(SparseMatrix.from_dense(expected).items()))
+        difference = dense.subtract(dense.transpose())
+        self.assertEqual(difference.get_element(2, 0), 4)
+        self.assertEqual(difference.get_element(0, 2), -4)
+        self.assertEqual(difference.get_element(1, 1), 0)
+
+        sink = MemorySink()
+        with instrument(sink):
+            dense.multiply(dense)
+        self.assertEqual(sink.records[0]["kernel"], "hybrid")
+        self.assertEqual(sink.records[0]["dense_rows"], 3)
+
+    def test_apply_delta(self):
+        delta_file = os.path.join(self.test_dir, "delta.txt")
+        with open(delta_file, 'w') as f:
+            f.write("rows=3\ncols=3\n(0, 0, -5)\n(1, 2, 4)\n")
+        for storage in ("csr", "csc", "dict"):
+            matrix = SparseMatrix(self.sample_file_1, storage=storage)
+            matrix.apply_delta(delta_file)
+            self.assertEqual(dict(matrix.items()), {(0, 2): 8, (1, 1): 3, (1, 2): 4, (2, 0): 6})
+            matrix.apply_delta(delta_file, subtract=True)
+            self.assertEqual(list(matrix.items()), list(SparseMatrix(self.sample_file_1).items()))
+        os.remove(delta_file)
+
+    def test_apply_product_delta(self):
+        left = SparseMatrix(self.sample_file_1)
+        right = SparseMatrix(self.sample_file_2)
+        left_delta = SparseMatrix.from_coo([0, 2], [1, 2], [2, -1], (3, 3))
+        right_delta = SparseMatrix.from_coo([1, 2], [0, 2], [-4, 3], (3, 3))
+        result = left.multiply(right)
+        result.apply_product_delta(left, right, left_delta, right_delta)
+        expected = left.add(left_delta).multiply(right.add(right_delta))
+        self.assertEqual(list(result.items()), list(expected.items()))
+
+        result = left.multiply(right).set_storage("dict")
+        result.apply_product_delta(left, right, left_delta=left_delta)
+        self.assertEqual(dict(result.items()), dict(left.add(left_delta).multiply(right).items()))
+        with self.assertRaises(ValueError):
+            result.apply_product_delta(left, right, SparseMatrix((2, 3)))
+
+    def test_matrix_service(self):
+        socket_path = os.path.join(self.test_dir, "service.sock")
+        ready = threading.Event()
+        server = threading.Thread(target=run_server, args=(socket_path,), kwargs={"ready": ready})
+        server.start()
+        self.assertTrue(ready.wait(10))
+        with MatrixClient(socket_path, timeout=30) as client:
+            self.assertEqual(client.load("A", self.sample_file_1)["nnz"], 4)
+            client.load("B", self.sample_file_2)
+            self.assertEqual(client.multiply("A", "B", "C")["name"], "C")
+            self.assertEqual(client.add("A", "B")["name"], "A+B")
+            self.assertEqual([entry["name"] for entry in client.list()], ["A", "A+B", "B", "C"])
+            self.assertEqual(client.matvec("A", [1, 2, 3]), [29, 6, 6])
+            client.save("C", self.output_file)
+            expected = SparseMatrix(self.sample_file_1).multiply(SparseMatrix(self.sample_file_2))
+            self.assertEqual(list(SparseMatrix(self.output_file).items()), list(expected.items()))
+            with self.assertRaises(ValueError):
+                client.subtract("A", "D")
+            client.drop("C")
+            self.assertEqual(len(client.list()), 3)
+            with self.assertRaisesRegex(ValueError, "Missing request field: path"):
+                client.request("load", name="D")
+            client.load("D", self.sample_file_1, storage="dict")
+            vectors = [[row, 1, -row] for row in range(8)]
+            client_results = []
+
+            def run_matvecs():
+                with MatrixClient(socket_path, timeout=30) as other:
+                    client_results.append([other.matvec("D", vector) for vector in vectors])
+
+            threads = [threading.Thread(target=run_matvecs) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(30)
+            expected_vectors = [SparseMatrix(self.sample_file_1).matvec(vector) for vector in vectors]
+            self.assertEqual(client_results, [expected_vectors] * 4)
+            client.shutdown()
+        server.join(10)
+        self.assertFalse(server.is_alive())
+        self.assertFalse(os.path.exists(socket_path))
+
+    def test_parallel_load(self):
+        matrix = SparseMatrix.load(self.sample_file_1, workers=2)
+        self.assertEqual(list(matrix.items()), list(SparseMatrix(self.sample_file_1).items()))
+
+        with open(self.output_file, 'w') as f:
+            f.write("rows=50\ncols=50\n")
+            for i in range(50):
+                f.write(f"({i}, {49 - i}, {i + 1})\n")
+        matrix = SparseMatrix.load(self.output_file, storage="csc", workers=3)
+        self.assertEqual(list(matrix.items()), list(SparseMatrix(self.output_file).items()))
+
+        with open(self.output_file, 'a') as f:
+            f.write("(3, 3, 2.5)\n")
+        with self.assertRaisesRegex(ValueError, r"line 53"):
+            SparseMatrix.load(self.output_file, workers=3)
+        with open(self.output_file, 'a') as f:
+            f.write("(50, 0, 1)\n")
+        with open(self.output_file) as f:
+            lines = f.read().splitlines()
+        lines[52] = "(3, 3, 2)"
+        with open(self.output_file, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        with self.assertRaisesRegex(ValueError, r"out of bounds: \(50, 0\) \(line 54\)"):
+            SparseMatrix.load(self.output_file, workers=3)
+
+    def test_elementwise_operations(self):
+        a = SparseMatrix(self.sample_file_1)
+        b = SparseMatrix(self.sample_file_2)
+        self.assertEqual(list(a.hadamard(b).items()), [((0, 0), 10), ((1, 1), 3)])
+        self.assertEqual(list(a.scale(-2).items()), [((0, 0), -10), ((0, 2), -16), ((1, 1), -6), ((2, 0), -12)])
+        self.assertEqual(a.scale(0).nnz, 0)
+        evens = a.map_values(lambda value: value if value % 2 == 0 else 0)
+        self.assertEqual(list(evens.items()), [((0, 2), 8), ((2, 0), 6)])
+        self.assertEqual(list(a.items()), list(SparseMatrix(self.sample_file_1).items()))
+        with self.assertRaises(ValueError):
+            a.hadamard(SparseMatrix((2, 3)))
+
+    def test_reductions(self):
+        for storage in ("csr", "csc", "dict"):
+            a = SparseMatrix(self.sample_file_1, storage=storage)
+            self.assertEqual(a.row_sums(), [13, 3, 6])
+            self.assertEqual(a.col_sums(), [11, 3, 8])
+            self.assertEqual(a.nnz_per_row(), [2, 1, 1])
+            self.assertEqual(a.trace(), 8)
+            self.assertAlmostEqual(a.norm(), math.sqrt(25 + 64 + 9 + 36))
+            self.assertEqual(a.norm(1), 11)
+            self.assertEqual(a.norm(math.inf), 13)
+            self.assertEqual((a.max(), a.min()), (8, 0))
+        full = SparseMatrix.from_dense([[2, 3], [4, 5]])
+        self.assertEqual((full.max(), full.min()), (5, 2))
+        self.assertEqual(SparseMatrix((2, 2)).max(), 0)
+        with self.assertRaises(ValueError):
+            SparseMatrix((0, 3)).min()
+
+    def test_packed_storage(self):
+        matrix = SparseMatrix((4, 5), storage="packed")
+        expected = SparseMatrix((4, 5))
+        for row, col, value in [(3, 4, 7), (0, 0, 1), (2, 1, 2 ** 70), (0, 0, 0), (1, 3, -2), (3, 4, 8)]:
+            matrix.set_element(row, col, value)
+            expected.set_element(row, col, value)
+        self.assertEqual(matrix.storage, "packed")
+        self.assertEqual(matrix.nnz, 3)
+        self.assertEqual(matrix.get_element(2, 1), 2 ** 70)
+        self.assertEqual(matrix.get_element(0, 0), 0)
+        self.assertEqual(list(matrix.items()), list(expected.items()))
+        self.assertEqual(list(matrix.transpose().items()), list(expected.transpose().items()))
+        matrix.iadd(expected)
+        self.assertEqual(list(matrix.items()), [((1, 3), -4), ((2, 1), 2 ** 71), ((3, 4), 16)])
+        self.assertIs(matrix.freeze(), matrix)
+        self.assertEqual(matrix.storage, "csr")
+        self.assertEqual(matrix.set_storage("packed").elements, {(1, 3): -4, (2, 1): 2 ** 71, (3, 4): 16})
+        floats = SparseMatrix(self.sample_file_1, storage="packed")
+        for row in range(3):
+            for col in range(3):
+                floats.set_element(row, col, row + col + 0.5)
+        self.assertEqual(floats.nnz, 9)
+        self.assertEqual(floats.trace(), 7.5)
+        with self.assertRaises(AttributeError):
+            floats.label = "A"
+
+    def test_synthetic_matrices(self):
+        text_path = os.path.join(self.test_dir, "synthetic.txt")
+        binary_path = os.path.join(self.test_dir, "synthetic.bin")
+        for structure in STRUCTURES:
+            SyntheticMatrix(60, 40, 0.2, structure, rng=random.Random(7), bandwidth=3, block_size=8).write(text_path)
+            SyntheticMatrix(60, 40, 0.2, structure, rng=random.Random(7), bandwidth=3,
+                            block_size=8).write(binary_path, binary=True)
+            generated = SyntheticMatrix(60, 40, 0.2, structure, rng=random.Random(7), bandwidth=3, block_size=8)
+            entries = list(generated.entries())
+            matrix = SparseMatrix(text_path)
+            self.assertTrue(is_binary_matrix_file(binary_path))
+            self.assertEqual(list(matrix.items()), list(SparseMatrix(binary_path).items()))
+            self.assertEqual(list(matrix.items()), [((row, col), value) for row, col, value in entries])
+            self.assertEqual(matrix.nnz, generated.nnz)
+            self.assertNotIn(0, [value for _, _, value in entries])
+            if structure in ("uniform", "power-law", "diagonal-dominant"):
+                self.assertEqual(matrix.nnz, int(60 * 40 * 0.2))
+            if structure == "banded":
+                self.assertTrue(all(abs(row - col) <= 3 for row, col, _ in entries))
+            if structure == "block-diagonal":
+                self.assertTrue(all(row // 8 == col // 8 for row, col, _ in entries))
+            if structure == "diagonal-dominant":
+                for row in range(40):
+                    values = dict(matrix.row(row))
+                    self.assertGreater(values[row], sum(abs(value) for col, value in values.items() if col != row))
+        os.remove(text_path)
+        os.remove(binary_path)
+        with self.assertRaises(ValueError):
+            SyntheticMatrix(10, 10, 1.5)
+        with self.assertRaises(ValueError):
+            SyntheticMatrix(10, 10, structure="circulant")
+
+
+    def test_bulk_construction_throughput(self):
+        cases = build_cases([1000], [0.05], operations=["from_coo", "set_element"], shapes=["square"])
+        bulk, loop = run_benchmarks(cases, repeat=5, isolate=False)["results"]
+        self.assertEqual(bulk["nnz"], loop["nnz"])
+        self.assertLess(bulk["seconds_min"], loop["seconds_min"])
+
+    def test_multiply_files_memory_budget(self):
+        column = SparseMatrix.from_coo(list(range(30)), [0] * 30, list(range(1, 31)), (30, 1))
+        row = SparseMatrix.from_coo([0] * 40, list(range(40)), [2] * 40, (1, 40))
+        column_file = os.path.join(self.test_dir, "column.txt")
+        row_file = os.path.join(self.test_dir, "row.txt")
+        column.save_to_file(column_file)
+        row.save_to_file(row_file)
+        sizes = []
+        multiply = out_of_core._multiply_compressed
+
+        def recording_multiply(*args):
+            product = multiply(*args)
+            sizes.append(product.nnz)
+            return product
+
+        out_of_core._multiply_compressed = recording_multiply
+        try:
+            count = SparseMatrix.multiply_files(column_file, row_file, self.output_file, memory_entries=30)
+        finally:
+            out_of_core._multiply_compressed = multiply
+        expected = column.multiply(row)
+        self.assertEqual(count, 30 * 40)
+        self.assertEqual(list(SparseMatrix(self.output_file).items()), list(expected.items()))
+        self.assertLessEqual(max(sizes), 10)
+        os.remove(column_file)
+        os.remove(row_file)
+
+    def test_hybrid_multiply_matches_sparse(self):
+        rng = random.Random(17)
+        size = 40
+        left = SparseMatrix.from_iterable(
+            [(row, col, rng.uniform(-1, 1) * 10 ** rng.randint(-6, 6))
+             for row in range(size) for col in rng.sample(range(size), 6)], (size, size))
+        right = SparseMatrix.from_iterable(
+            [(row, col, rng.uniform(-1, 1) * 10 ** rng.randint(-6, 6))
+             for row in range(size) for col in rng.sample(range(size), 30 if row % 4 == 0 else 3)],
+            (size, size))
+        self.assertEqual(left.explain("multiply", right).kernel, "hybrid")
+        self.assertEqual(list(left.multiply(right).items()), list(left.multiply(right, workers=2).items()))
+
+        infinite = SparseMatrix.from_coo([0], [0], [math.inf], (4, 4))
+        row = SparseMatrix.from_coo([0, 0], [0, 1], [1.0, 2.0], (4, 4))
+        self.assertEqual(infinite.explain("multiply", row).kernel, "sparse")
+        self.assertEqual(dict(infinite.multiply(row).items()), {(0, 0): math.inf, (0, 1): math.inf})
+
+    def test_update_binary_result(self):
+        paths = {name: os.path.join(self.test_dir, name) for name in ("A.bin", "B.bin", "R.bin", "dA.txt")}
+        SparseMatrix(self.sample_file_1).save_binary(paths["A.bin"])
+        SparseMatrix.from_coo([0, 2], [0, 2], [2.5, 7.0], (3, 3)).save_binary(paths["B.bin"])
+        operands = ["--A", paths["A.bin"], "--B", paths["B.bin"]]
+        self.assertEqual(run_batch(["eval", "A*B", "-o", paths["R.bin"], "--binary"] + operands), 0)
+        for delta in ("(2, 1, 4)\n", "(1, 0, 1)\n"):
+            with open(paths["dA.txt"], 'w') as f:
+                f.write("rows=3\ncols=3\n" + delta)
+            update = ["update", "A*B", "--result", paths["R.bin"], "--delta", f"A={paths['dA.txt']}",
+                      "--update-operands"]
+            self.assertEqual(run_batch(update + operands), 0)
+            expected = SparseMatrix(paths["A.bin"]).multiply(SparseMatrix(paths["B.bin"]))
+            self.assertTrue(is_binary_matrix_file(paths["R.bin"]))
+            self.assertTrue(is_binary_matrix_file(paths["A.bin"]))
+            self.assertEqual(list(SparseMatrix(paths["R.bin"]).items()), list(expected.items()))
+        self.assertEqual(SparseMatrix(paths["A.bin"]).get_element(1, 0), 1)
+        for path in paths.values():
+            os.remove(path)
+
+    def test_dense_products_keep_mutable_storage(self):
+        for storage in ("packed", "dict"):
+            matrix = SparseMatrix(self.sample_file_1, storage=storage)
+            self.assertEqual(matrix.matvec([1, 2, 3]), [29, 6, 6])
+            self.assertEqual(matrix.rmatvec([1, 2, 3]), [23, 6, 8])
+            self.assertEqual(matrix.storage, storage)
+            matrix.set_element(1, 2, 4)
+            self.assertEqual(matrix.storage, storage)
+            self.assertEqual(matrix.matvec([1, 2, 3]), [29, 18, 6])
+
+    def test_structured_storage(self):
+        n = 12
+        diagonal = [(i, i, i - 5) for i in range(n) if i != 5]
+        tridiagonal = [(i, j, (i * 7 + j) % 5 - 2) for i in range(n) for j in (i - 1, i, i + 1)
+                       if 0 <= j < n and (i * 7 + j) % 5 != 2]
+        symmetric = [(i, j, 0.5 * (i + j)) for i in range(n) for j in range(n) if (i * j) % 3 == 1]
+        upper = [(i, j, i + j + 1) for i in range(n) for j in range(i, n, 4)]
+        general = upper + [(n - 1, 0, 3)]
+        cases = [(diagonal, "diagonal"), (tridiagonal, "banded"), (symmetric, "symmetric"),
+                 (upper, "upper-triangular"), (general, "general")]
+        plain_path = os.path.join(self.test_dir, "plain.txt")
+        special_path = os.path.join(self.test_dir, "special.txt")
+        matrices = []
+        for entries, structure in cases:
+            plain = SparseMatrix.from_iterable(entries, (n, n))
+            special = SparseMatrix.from_iterable(entries, (n, n)).set_storage("auto")
+            self.assertEqual(plain.structure, structure)
+            self.assertEqual(special.structure, structure)
+            self.assertEqual(special.storage, structure if structure in STRUCTURED_FORMATS else "csr")
+            self.assertEqual(special.nnz, plain.nnz)
+            self.assertEqual(list(special.items()), list(plain.items()))
+            self.assertEqual(list(special.transpose().items()), list(plain.transpose().items()))
+            self.assertEqual(special.get_element(3, 4), plain.get_element(3, 4))
+            self.assertEqual(special.trace(), plain.trace())
+            vector = [1, -2, 0.5, 3] * 3
+            self.assertEqual(special.matvec(vector), plain.matvec(vector))
+            plain.save_to_file(plain_path)
+            special.save_to_file(special_path)
+            with open(plain_path) as expected, open(special_path) as actual:
+                self.assertEqual(actual.read(), expected.read())
+            matrices.append((plain, special))
+        os.remove(plain_path)
+        os.remove(special_path)
+        for plain_a, special_a in matrices:
+            for plain_b, special_b in matrices:
+                for operation in ("add", "subtract", "multiply"):
+                    expected = getattr(plain_a, operation)(plain_b)
+                    actual = getattr(special_a, operation)(special_b)
+                    self.assertEqual(list(actual.items()), list(expected.items()))
+        self.assertEqual(matrices[0][1].explain("multiply", matrices[4][1]).kernel, "diagonal")
+        self.assertEqual(matrices[1][1].explain("add", matrices[0][1]).kernel, "banded")
+        self.assertEqual(matrices[1][1].add(matrices[0][1]).storage, "banded")
+        self.assertEqual(matrices[2][1].add(matrices[2][1]).storage, "symmetric")
+        self.assertLess(matrices[2][1]._structured.nbytes, matrices[2][0]._compressed.nbytes)
+        self.assertEqual(SparseMatrix.from_iterable([(0, 1, 1)], (2, 3)).structure, "general")
+        with self.assertRaises(ValueError):
+            matrices[4][0].set_storage("symmetric")
+        special = matrices[1][1]
+        special.set_element(0, 11, 9)
+        self.assertEqual(special.storage, "dict")
+        self.assertEqual(special.get_element(0, 11), 9)
+        self.assertEqual(special.structure, "general")
+
+    def test_structure_of_full_triangles(self):
+        size = 6
+        upper = SparseMatrix.from_iterable(
+            [(row, col, row + col + 1) for row in range(size) for col in range(row, size)], (size, size))
+        self.assertEqual(upper.structure, "upper-triangular")
+        self.assertEqual(upper.transpose().structure, "lower-triangular")
+        self.assertEqual(upper.set_storage("auto").storage, "csr")
+        dense = SparseMatrix.from_iterable(
+            [(row, col, row * col + 1) for row in range(size) for col in range(size)], (size, size))
+        self.assertEqual(dense.structure, "symmetric")
+        self.assertEqual(dense.set_storage("auto").storage, "symmetric")
+
+
 if __name__ == "__main__":
     unittest.main()